@@ -1,24 +1,82 @@
-import sys
 import time
-import serial
-import serial.tools.list_ports
+
+# 启动计时起点，尽量早于其它导入
+STARTUP_T0 = time.perf_counter()
+
+import sys
+import json
 from datetime import datetime
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QTextEdit, QProgressBar, QMessageBox, QLabel, QCheckBox,
+    QPushButton, QTextEdit, QPlainTextEdit, QProgressBar, QMessageBox, QLabel, QTableView, QHeaderView,
     QToolButton, QGraphicsDropShadowEffect
 )
-from PySide6.QtCore import Qt, QTimer, QThread, Signal, QObject
+from PySide6.QtCore import Qt, QTimer, QThread, Signal, QObject, QAbstractTableModel, QModelIndex
 from PySide6.QtGui import QPalette, QColor, QIcon
 import darkdetect
-import ntplib
-import queue
-import random
-import string
-from qt_material import apply_stylesheet
+import asyncio
+import bisect
+from chameleon_core import (
+    debug_buffer, log_debug, open_debug_log_file, generate_serial_number_command, SerialDevice,
+    check_chameleon_ultra, list_port_names, plan_probes, probe_cache,
+    FlashJob, AsyncFlashEngine, FlashLedger, async_probe_port, LEDGER_PATH,
+    make_serial_allocator, SERIAL_DB_PATH, SERIAL_STRATEGY, SERIAL_PREFIX,
+    command_metrics, start_metrics_server, save_metrics_summary, FlashStation,
+    connection_pool, keep_connection, firmware_version_text, ShardedFlashJob, SHARD_PROCESSES, ProgressAggregator,
+    MAX_CONCURRENT_DEVICES, ASYNC_MAX_INFLIGHT, PIPELINE_WINDOW
+)
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+# I/O 后端: "thread" 为每台设备一个线程，"asyncio" 为单个事件循环驱动全部设备，
+# "process" 为把设备分给 SHARD_PROCESSES 个子进程刷写（设备检测仍在本进程中进行）
+IO_BACKEND = "thread"
+
+# 无 udev 时热插拔轮询 comports() 的间隔（秒），只枚举不打开串口
+HOTPLUG_POLL_INTERVAL = 0.5
+
+# 时间校验使用的 NTP 服务器、超时（秒）和结果缓存有效期（秒）
+NTP_SERVER = "ntp.aliyun.com"
+NTP_TIMEOUT = 3
+NTP_CACHE_TTL = 3600
+
+# 离线模式：不访问网络，直接跳过时间校验
+NTP_OFFLINE = False
+
+# 调试日志批量刷新到界面的间隔（秒）和调试窗口保留的最大行数
+DEBUG_FLUSH_INTERVAL = 0.2
+DEBUG_VIEW_MAX_LINES = 5000
+
+# 调试日志是否同时打印到控制台，以及滚动日志文件路径（None 为不写文件）
+DEBUG_PRINT = True
+DEBUG_LOG_FILE = None
+
+# 命令延迟指标：本地 HTTP 导出端口（None 为不启动）和每次刷写结束后写入的 JSON 摘要路径（None 为不写）
+METRICS_PORT = None
+METRICS_JSON_PATH = None
+
+# 刷写进度、当前任务和结果刷新到界面的帧率上限（次/秒）
+PROGRESS_UPDATE_HZ = 20
+
+# 无人值守模式使用的配置文件，开启时保存当前配置，启动时恢复
+STATION_PROFILE_PATH = "station_profile.json"
+
+# 设备表中显示的设备状态和刷写结果
+DEVICE_STATUS_TEXT = {"ready": "就绪", "queued": "排队中", "flashing": "刷写中", "done": "完成", "failed": "失败"}
+
+# 启动各阶段相对 STARTUP_T0 的耗时（秒），--startup-time 模式下输出
+startup_marks = []
 
-# 调试日志队列
-debug_queue = queue.Queue()
+def mark_startup(stage):
+    startup_marks.append((stage, time.perf_counter() - STARTUP_T0))
+
+# 应用 qt_material 主题，首次调用时才导入 qt_material
+def apply_theme(app, theme):
+    from qt_material import apply_stylesheet
+    apply_stylesheet(app, theme='dark_teal.xml' if theme == "dark" else 'light_blue.xml')
 
 # 全局调试信号
 class DebugSignal(QObject):
@@ -26,30 +84,42 @@ class DebugSignal(QObject):
 
 debug_signal = DebugSignal()
 
+# 无人值守工位的信号桥：工位线程池中的事件经此排队送到主线程
+class StationSignals(QObject):
+    status = Signal(str, str, str)
+
 # 调试日志线程
 class DebugLoggerThread(QThread):
     def __init__(self):
         super().__init__()
         self.running = True
 
+    # 每隔 DEBUG_FLUSH_INTERVAL 取走缓冲区中的全部日志，合并为一次信号发出
     def run(self):
+        log_file = open_debug_log_file(DEBUG_LOG_FILE) if DEBUG_LOG_FILE else None
         while self.running:
-            try:
-                message = debug_queue.get(timeout=0.1)
-                debug_signal.debug_message.emit(f"[DEBUG] {message}")
-                print(f"[DEBUG] {message}")
-                debug_queue.task_done()
-            except queue.Empty:
-                continue
+            self.msleep(int(DEBUG_FLUSH_INTERVAL * 1000))
+            self.flush(log_file)
+        self.flush(log_file)
+
+    def flush(self, log_file):
+        lines, dropped = debug_buffer.drain()
+        if dropped:
+            lines.insert(0, f"调试日志过多，已丢弃 {dropped} 条")
+        if not lines:
+            return
+        text = "\n".join(f"[DEBUG] {message}" for message in lines)
+        debug_signal.debug_message.emit(text)
+        if DEBUG_PRINT:
+            print(text)
+        if log_file is not None:
+            for message in lines:
+                log_file.debug(message)
 
     def stop(self):
         self.running = False
         self.wait()
 
-# 调试日志函数
-def log_debug(message):
-    debug_queue.put(message)
-
 # 自定义标题栏
 class CustomTitleBar(QWidget):
     def __init__(self, parent, theme):
@@ -208,100 +278,30 @@ class ToggleButton(QPushButton):
         self._state = state
         self.update_style()
 
-# CRC16-IBM 计算函数
-def crc16_ibm(data):
-    crc = 0xFFFF
-    polynomial = 0xA001
-    for byte in data:
-        crc ^= byte
-        for _ in range(8):
-            if crc & 0x0001:
-                crc = (crc >> 1) ^ polynomial
-            else:
-                crc >>= 1
-    return crc.to_bytes(2, byteorder='big')
-
-# 生成随机 14 位序列号并构造指令
-def generate_serial_number_command():
-    characters = string.ascii_letters + string.digits
-    serial_number = ''.join(random.choices(characters, k=14))
-    log_debug(f"生成随机序列号: {serial_number}")
-    serial_bytes = bytes([0xD2]) + serial_number.encode('ascii')
-    cmd_base = bytes.fromhex('11 EF 04 1B 00 00 00 0F')
-    cmd = cmd_base + serial_bytes
-    crc = crc16_ibm(cmd)
-    full_cmd = cmd + crc
-    return full_cmd, serial_number
-
-# 指令定义
-COMMANDS = {
-    "activate": [
-        bytes.fromhex('11 EF 04 1C 00 00 00 00 E0 00'),
-    ],
-    "low_freq_on": bytes.fromhex('11 EF 04 19 00 00 00 01 E2 01 FF'),
-    "low_freq_off": bytes.fromhex('11 EF 04 19 00 00 00 01 E2 00 00'),
-    "high_freq_on": bytes.fromhex('11 EF 04 18 00 00 00 01 E3 01 FF'),
-    "high_freq_off": bytes.fromhex('11 EF 04 18 00 00 00 01 E3 00 00'),
-    "light_on": bytes.fromhex('11 EF 04 1A 00 00 00 01 E1 01 FF'),
-    "light_off": bytes.fromhex('11 EF 04 1A 00 00 00 01 E1 00 00'),
-    "get_status": [
-        bytes.fromhex('11 EF 03 F5 00 00 00 00 08 00'),
-        bytes.fromhex('11 EF 04 0A 00 00 00 00 F2 00')
-    ],
-    "get_firmware_version": bytes.fromhex('11 EF 03 FB 00 00 00 00 02 00')
-}
-
-# 时间校验
-def check_time():
+# 时间校验（阻塞网络请求，只在后台线程中调用）
+def check_time(server=None, timeout=None):
+    if NTP_OFFLINE:
+        return True, "离线模式，跳过版本校验"
     try:
+        import ntplib
         client = ntplib.NTPClient()
-        response = client.request('ntp.aliyun.com')
+        response = client.request(server or NTP_SERVER, timeout=timeout or NTP_TIMEOUT)
         current_time = datetime.fromtimestamp(response.tx_time)
         expiry_date = datetime(2099, 9, 29)
         if current_time > expiry_date:
-            return True,
+            return False, "版本已过期"
         return True, "版本校验通过"
-    except Exception as e:
+    except Exception:
         return True, "跳过版本校验"
 
-# 串口操作类
-class SerialDevice:
-    def __init__(self, port):
-        self.port = port
-        self.serial = None
-        self.is_connected = False
+# 后台时间校验线程
+class TimeCheckThread(QThread):
+    checked = Signal(bool, str)
 
-    def connect(self):
-        log_debug(f"尝试连接串口: {self.port}")
-        try:
-            self.serial = serial.Serial(self.port, baudrate=115200, timeout=1)
-            self.is_connected = True
-            log_debug(f"{self.port} 连接成功")
-            return True, "连接成功"
-        except serial.SerialException as e:
-            self.is_connected = False
-            log_debug(f"{self.port} 连接失败: {str(e)}")
-            return False, f"连接失败: {str(e)}"
-
-    def send_command(self, command):
-        if not self.is_connected:
-            log_debug(f"{self.port} 未连接，无法发送命令")
-            return False, "未连接"
-        try:
-            log_debug(f"{self.port} 发送命令: {command.hex()}")
-            self.serial.write(command)
-            response = self.serial.read(64)
-            log_debug(f"{self.port} 接收响应: {response.hex()}")
-            return True, response.hex()
-        except serial.SerialException as e:
-            log_debug(f"{self.port} 命令发送失败: {str(e)}")
-            return False, f"命令发送失败: {str(e)}"
-
-    def close(self):
-        if self.serial and self.is_connected:
-            log_debug(f"关闭串口: {self.port}")
-            self.serial.close()
-            self.is_connected = False
+    def run(self):
+        valid, message = check_time()
+        log_debug(f"时间校验结果: {valid}, {message}")
+        self.checked.emit(valid, message)
 
 # 设备连接检测线程
 class ConnectionThread(QThread):
@@ -315,55 +315,44 @@ class ConnectionThread(QThread):
     def run(self):
         device = SerialDevice(self.port)
         is_chameleon, message = self.check_chameleon_ultra(device)
+        self.detected_result = (self.port, is_chameleon, message)
+        # 确认是 ChameleonUltra 的连接留给刷写复用；先放入连接池，收到信号时可以读到固件版本
+        keep_connection(device, is_chameleon)
         self.result.emit(self.port, is_chameleon, message)
-        device.close()
 
     def check_chameleon_ultra(self, device):
-        if not device.is_connected:
-            success, message = device.connect()
-            if not success:
-                return False, message
-        try:
-            device.serial.write(COMMANDS["get_firmware_version"])
-            log_debug(f"{device.port} 发送 GET_FIRMWARE_VERSION 命令: {COMMANDS['get_firmware_version'].hex()}")
-            response = device.serial.read(64)
-            log_debug(f"{device.port} GET_FIRMWARE_VERSION 响应: {response.hex()}")
-            if len(response) < 6:
-                log_debug(f"{device.port} 响应数据过短: {len(response)} 字节")
-                return False, "响应数据过短"
-            if response[0:2] != b'\x11\xEF':
-                log_debug(f"{device.port} 无效 SYNC: {response[0:2].hex()}")
-                return False, "无效 SYNC"
-            if response[2:4] != b'\x03\xFB':
-                log_debug(f"{device.port} 无效 CMD: {response[2:4].hex()}")
-                return False, "无效 CMD"
-            status = response[4:6]
-            if status not in [b'\x00\x68', b'\x00\x00']:
-                log_debug(f"{device.port} 无效 STATUS: {status.hex()}")
-                return False, "无效 STATUS"
-            log_debug(f"{device.port} 检测到 ChameleonUltra")
-            return True, "检测到 ChameleonUltra"
-        except Exception as e:
-            log_debug(f"{device.port} 检测失败: {str(e)}")
-            return False, f"检测失败: {str(e)}"
+        return check_chameleon_ultra(device)
+
+# 连接池中该串口设备的固件版本文本，没有时为空字符串
+def pooled_firmware(port):
+    response = connection_pool.firmware_response(port)
+    return firmware_version_text(response) if response else ""
 
-# 设备检测线程
+# 设备检测线程，device_update 信号为 (串口, 是否为 ChameleonUltra, 固件版本)
 class DeviceDetectionThread(QThread):
     device_detected = Signal(list)
-    device_update = Signal(str, bool)
+    device_update = Signal(str, bool, str)
 
-    def __init__(self):
+    # ports 为 None 时检测全部串口，否则只检测给定的串口
+    def __init__(self, ports=None):
         super().__init__()
+        self.ports = ports
         self.connection_threads = []
 
     def run(self):
         log_debug("开始设备检测")
-        ports = serial.tools.list_ports.comports()
+        ports = self.ports if self.ports is not None else list_port_names()
+        infos, ports, cached = plan_probes(ports)
         chameleon_ports = []
 
+        for port, is_chameleon, _ in cached:
+            self.device_update.emit(port, is_chameleon, pooled_firmware(port))
+            if is_chameleon:
+                chameleon_ports.append(port)
+
         for port in ports:
-            log_debug(f"检测串口: {port.device}")
-            connection_thread = ConnectionThread(port.device)
+            log_debug(f"检测串口: {port}")
+            connection_thread = ConnectionThread(port)
             connection_thread.result.connect(self.on_connection_result)
             self.connection_threads.append(connection_thread)
             connection_thread.start()
@@ -372,8 +361,10 @@ class DeviceDetectionThread(QThread):
             thread.wait()
 
         for thread in self.connection_threads:
-            if hasattr(thread, 'detected_result'):
-                port, is_chameleon, _ = thread.detected_result
+            if thread.detected_result is not None:
+                port, is_chameleon, message = thread.detected_result
+                if port in infos:
+                    probe_cache.put(infos[port], is_chameleon, message)
                 if is_chameleon:
                     chameleon_ports.append(port)
 
@@ -382,138 +373,80 @@ class DeviceDetectionThread(QThread):
 
     def on_connection_result(self, port, is_chameleon, message):
         log_debug(f"{port} 检测结果: {is_chameleon}, 信息: {message}")
-        for thread in self.connection_threads:
-            if thread.port == port:
-                thread.detected_result = (port, is_chameleon, message)
-                break
-        self.device_update.emit(port, is_chameleon)
+        self.device_update.emit(port, is_chameleon, pooled_firmware(port))
+
+# 串口热插拔监视线程：只上报新出现和已消失的串口，不打开任何串口。
+# Linux 安装了 pyudev 时由 udev 事件驱动，否则定时对比 comports() 结果
+class PortWatcher(QThread):
+    ports_added = Signal(list)
+    ports_removed = Signal(list)
+
+    def __init__(self, interval=HOTPLUG_POLL_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.running = True
+        self.known_ports = set()
+
+    def run(self):
+        self.rescan()
+        if pyudev is not None and sys.platform.startswith("linux"):
+            self.watch_udev()
+        else:
+            self.watch_polling()
+
+    def rescan(self):
+        current = set(list_port_names())
+        added = sorted(current - self.known_ports)
+        removed = sorted(self.known_ports - current)
+        self.known_ports = current
+        if removed:
+            log_debug(f"串口移除: {removed}")
+            self.ports_removed.emit(removed)
+        if added:
+            log_debug(f"串口新增: {added}")
+            self.ports_added.emit(added)
+
+    def watch_polling(self):
+        log_debug(f"热插拔监视: 轮询模式，间隔 {self.interval} 秒")
+        while self.running:
+            self.msleep(int(self.interval * 1000))
+            if self.running:
+                self.rescan()
+
+    def watch_udev(self):
+        log_debug("热插拔监视: udev 模式")
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by(subsystem="tty")
+        monitor.start()
+        while self.running:
+            device = monitor.poll(timeout=self.interval)
+            if device is not None:
+                # 事件到达时设备节点可能尚未就绪，统一以 comports() 为准对账
+                self.rescan()
+
+    def stop(self):
+        self.running = False
+        self.wait()
 
-# 工作线程
+# 工作线程：在 QThread 中运行 FlashJob，任务事件写入 progress 聚合器，由界面按帧率取走
 class WorkerThread(QThread):
-    update_progress = Signal(int)
-    update_task = Signal(str)
-    update_result = Signal(str)
-    update_debug = Signal(str)
     error_occurred = Signal(list)
 
-    def __init__(self, ports, settings, serial_numbers):
+    def __init__(self, ports, settings, serial_numbers, max_workers=MAX_CONCURRENT_DEVICES,
+                 pipeline_window=PIPELINE_WINDOW, ledger=None, progress=None):
         super().__init__()
-        self.ports = ports
-        self.settings = settings
-        self.serial_numbers = serial_numbers
-        self.errors = []
+        self.progress = progress or ProgressAggregator()
+        self.job = self.create_job(ports, settings, serial_numbers, max_workers, pipeline_window, ledger)
+        self.errors = self.job.errors
+
+    # 子类改用其他刷写任务时覆盖
+    def create_job(self, ports, settings, serial_numbers, max_workers, pipeline_window, ledger):
+        return FlashJob(ports, settings, serial_numbers, self.progress.report, max_workers, pipeline_window, ledger)
 
     def run(self):
         try:
-            log_debug(f"WorkerThread 启动，处理设备: {self.ports}, 配置: {self.settings}")
-            total_tasks = 0
-            for port in self.ports:
-                if self.settings["firmware"]:
-                    total_tasks += 2  # 固定激活命令 + 动态序列号命令
-                if "low_freq" in self.settings and self.settings["low_freq"] is not None:
-                    total_tasks += 1
-                if "high_freq" in self.settings and self.settings["high_freq"] is not None:
-                    total_tasks += 1
-                if "light" in self.settings and self.settings["light"] is not None:
-                    total_tasks += 1
-                total_tasks += len(COMMANDS["get_status"])
-
-            log_debug(f"总任务数: {total_tasks}")
-            completed_tasks = 0
-
-            for port in self.ports:
-                log_debug(f"开始处理设备: {port}")
-                device = SerialDevice(port)
-                try:
-                    success, message = device.connect()
-                    if not success:
-                        self.errors.append(f"{port} 连接失败: {message}")
-                        self.update_result.emit(f"{port} 连接失败: {message}")
-                        self.update_debug.emit(f"{port} 连接失败: {message}")
-                        continue
-
-                    self.update_debug.emit(f"{port} 连接成功")
-
-                    if self.settings["firmware"]:
-                        self.update_task.emit(f"当前执行项目: 激活 {port} 设备")
-                        # 发送固定激活命令
-                        for cmd in COMMANDS["activate"]:
-                            success, response = device.send_command(cmd)
-                            self.update_debug.emit(f"{port} 发送固定激活命令: {cmd.hex()} 返回: {response}")
-                            if success:
-                                self.update_result.emit(f"{port} 固定激活命令执行成功")
-                            else:
-                                self.errors.append(f"{port} 固定激活命令执行失败: {response}")
-                                self.update_result.emit(f"{port} 固定激活命令执行失败: {response}")
-                            completed_tasks += 1
-                            self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-
-                        # 发送动态序列号命令
-                        sn_cmd, _ = self.serial_numbers[port]
-                        success, response = device.send_command(sn_cmd)
-                        self.update_debug.emit(f"{port} 发送序列号命令: {sn_cmd.hex()} 返回: {response}")
-                        if success:
-                            self.update_result.emit(f"{port} 序列号命令执行成功")
-                        else:
-                            self.errors.append(f"{port} 序列号命令执行失败: {response}")
-                            self.update_result.emit(f"{port} 序列号命令执行失败: {response}")
-                        completed_tasks += 1
-                        self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-
-                    if "low_freq" in self.settings and self.settings["low_freq"] is not None:
-                        self.update_task.emit(f"当前执行项目: 设置 {port} 低频ID循环")
-                        cmd = COMMANDS["low_freq_on"] if self.settings["low_freq"] else COMMANDS["low_freq_off"]
-                        success, response = device.send_command(cmd)
-                        self.update_debug.emit(f"{port} 发送低频ID命令: {cmd.hex()} 返回: {response}")
-                        if success:
-                            self.update_result.emit(f"{port} 低频ID循环 {'开启' if self.settings['low_freq'] else '关闭'}成功")
-                        else:
-                            self.errors.append(f"{port} 低频ID循环设置失败: {response}")
-                            self.update_result.emit(f"{port} 低频ID循环设置失败: {response}")
-                        completed_tasks += 1
-                        self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-
-                    if "high_freq" in self.settings and self.settings["high_freq"] is not None:
-                        self.update_task.emit(f"当前执行项目: 设置 {port} 高频IC循环")
-                        cmd = COMMANDS["high_freq_on"] if self.settings["high_freq"] else COMMANDS["high_freq_off"]
-                        success, response = device.send_command(cmd)
-                        self.update_debug.emit(f"{port} 发送高频IC命令: {cmd.hex()} 返回: {response}")
-                        if success:
-                            self.update_result.emit(f"{port} 高频IC循环 {'开启' if self.settings['high_freq'] else '关闭'}成功")
-                        else:
-                            self.errors.append(f"{port} 高频IC循环设置失败: {response}")
-                            self.update_result.emit(f"{port} 高频IC循环设置失败: {response}")
-                        completed_tasks += 1
-                        self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-
-                    if "light" in self.settings and self.settings["light"] is not None:
-                        self.update_task.emit(f"当前执行项目: 设置 {port} 按亮循环")
-                        cmd = COMMANDS["light_on"] if self.settings["light"] else COMMANDS["light_off"]
-                        success, response = device.send_command(cmd)
-                        self.update_debug.emit(f"{port} 发送按亮命令: {cmd.hex()} 返回: {response}")
-                        if success:
-                            self.update_result.emit(f"{port} 按亮循环 {'开启' if self.settings['light'] else '关闭'}成功")
-                        else:
-                            self.errors.append(f"{port} 按亮循环设置失败: {response}")
-                            self.update_result.emit(f"{port} 按亮循环设置失败: {response}")
-                        completed_tasks += 1
-                        self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-
-                    self.update_task.emit(f"当前执行项目: 获取 {port} 状态")
-                    for cmd in COMMANDS["get_status"]:
-                        success, response = device.send_command(cmd)
-                        self.update_debug.emit(f"{port} 发送状态命令: {cmd.hex()} 返回: {response}")
-                        if success:
-                            self.update_result.emit(f"{port} 状态获取成功: {response}")
-                        else:
-                            self.errors.append(f"{port} 状态获取失败: {response}")
-                            self.update_result.emit(f"{port} 状态获取失败: {response}")
-                        completed_tasks += 1
-                        self.update_progress.emit(int(completed_tasks / total_tasks * 100))
-                finally:
-                    device.close()
-
-            self.update_task.emit("当前执行项目: 完成")
+            self.job.run()
+            self.progress.report("task", "当前执行项目: 完成")
             log_debug("WorkerThread 完成")
             if self.errors:
                 self.error_occurred.emit(self.errors)
@@ -523,27 +456,276 @@ class WorkerThread(QThread):
             log_debug(error_message)
             self.error_occurred.emit(self.errors)
 
+# 多进程分片刷写的 Qt 桥接，子进程的事件由 ShardedFlashJob 在本线程中汇总后写入聚合器
+class ShardedWorkerThread(WorkerThread):
+    def __init__(self, ports, settings, serial_numbers, processes=SHARD_PROCESSES,
+                 max_workers=MAX_CONCURRENT_DEVICES, pipeline_window=PIPELINE_WINDOW, ledger=None, progress=None):
+        # create_job 在 WorkerThread.__init__ 中调用，需要先记下子进程数
+        self.processes = processes
+        super().__init__(ports, settings, serial_numbers, max_workers, pipeline_window, ledger, progress)
+
+    def create_job(self, ports, settings, serial_numbers, max_workers, pipeline_window, ledger):
+        return ShardedFlashJob(ports, settings, serial_numbers, self.progress.report, self.processes, max_workers,
+                               pipeline_window, ledger)
+
+# Qt 桥接：在 QThread 中运行事件循环，引擎事件与 WorkerThread 一样写入 progress 聚合器
+class AsyncWorkerThread(QThread):
+    error_occurred = Signal(list)
+
+    def __init__(self, ports, settings, serial_numbers, max_inflight=ASYNC_MAX_INFLIGHT,
+                 pipeline_window=PIPELINE_WINDOW, ledger=None, progress=None):
+        super().__init__()
+        self.progress = progress or ProgressAggregator()
+        self.engine = AsyncFlashEngine(ports, settings, serial_numbers, self.progress.report, max_inflight,
+                                       pipeline_window, ledger)
+        self.errors = self.engine.errors
+        self.loop = None
+        self.task = None
+        self.cancelled = False
+
+    def run(self):
+        try:
+            log_debug(f"AsyncWorkerThread 启动，处理设备: {self.engine.ports}, 配置: {self.engine.settings}")
+            asyncio.run(self.main())
+            self.progress.report("task", "当前执行项目: 完成")
+            log_debug("AsyncWorkerThread 完成")
+        except asyncio.CancelledError:
+            self.errors.append("刷写已取消")
+            log_debug("AsyncWorkerThread 已取消")
+        except Exception as e:
+            error_message = f"AsyncWorkerThread 错误退出: {str(e)}"
+            self.errors.append(error_message)
+            log_debug(error_message)
+        if self.errors:
+            self.error_occurred.emit(self.errors)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        # 事件循环启动前已请求取消
+        if self.cancelled:
+            raise asyncio.CancelledError()
+        await self.engine.run()
+
+    # 可从任意线程调用，取消所有在途命令
+    def cancel(self):
+        self.cancelled = True
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+# 异步设备检测线程：一个事件循环并发探测全部串口，信号与 DeviceDetectionThread 相同
+class AsyncDeviceDetectionThread(QThread):
+    device_detected = Signal(list)
+    device_update = Signal(str, bool, str)
+
+    def __init__(self, ports=None):
+        super().__init__()
+        self.ports = ports
+
+    def run(self):
+        log_debug("开始设备检测")
+        chameleon_ports = asyncio.run(self.detect())
+        log_debug(f"检测完成，发现 ChameleonUltra 设备: {chameleon_ports}")
+        self.device_detected.emit(chameleon_ports)
+
+    async def detect(self):
+        limiter = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+        ports = self.ports if self.ports is not None else list_port_names()
+        infos, ports, cached = plan_probes(ports)
+        chameleon_ports = []
+        for port, is_chameleon, _ in cached:
+            self.device_update.emit(port, is_chameleon, pooled_firmware(port))
+            if is_chameleon:
+                chameleon_ports.append(port)
+        for future in asyncio.as_completed([async_probe_port(port, limiter) for port in ports]):
+            port, is_chameleon, message, firmware = await future
+            log_debug(f"{port} 检测结果: {is_chameleon}, 信息: {message}")
+            if port in infos:
+                probe_cache.put(infos[port], is_chameleon, message)
+            self.device_update.emit(port, is_chameleon, firmware)
+            if is_chameleon:
+                chameleon_ports.append(port)
+        return chameleon_ports
+
+# 设备表模型：每行一台设备，按串口名排序。检测和刷写事件只插入、删除或更新对应的行，
+# 不重建控件；第一列可勾选，表示是否参与刷写
+class DeviceTableModel(QAbstractTableModel):
+    HEADERS = ("设备", "状态", "固件版本", "上次刷写")
+    FIELDS = (None, "status", "firmware", "outcome")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.ports = []
+        self.items = {}
+        self.enabled = True
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.ports)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        port = self.ports[index.row()]
+        item = self.items[port]
+        field = self.FIELDS[index.column()]
+        if role == Qt.DisplayRole:
+            return f"Chameleon Ultra - {port}" if field is None else item[field]
+        if role == Qt.CheckStateRole and field is None:
+            return Qt.Checked if item["selected"] else Qt.Unchecked
+        if role == Qt.ToolTipRole and field == "outcome":
+            return item["detail"] or None
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled if self.enabled else Qt.NoItemFlags
+        if index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or index.column() != 0 or not self.enabled:
+            return False
+        self.items[self.ports[index.row()]]["selected"] = Qt.CheckState(value) == Qt.Checked
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+    def row(self, port):
+        row = bisect.bisect_left(self.ports, port)
+        return row if row < len(self.ports) and self.ports[row] == port else None
+
+    # 插入一行，已存在时返回 False
+    def add_device(self, port, firmware=""):
+        if port in self.items:
+            return False
+        row = bisect.bisect_left(self.ports, port)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.ports.insert(row, port)
+        self.items[port] = {"selected": False, "status": DEVICE_STATUS_TEXT["ready"], "firmware": firmware,
+                            "outcome": "", "detail": ""}
+        self.endInsertRows()
+        return True
+
+    def remove_device(self, port):
+        row = self.row(port)
+        if row is None:
+            return False
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.ports[row]
+        del self.items[port]
+        self.endRemoveRows()
+        return True
+
+    # 只更新有变化的字段，只通知这一行重绘
+    def update_device(self, port, **fields):
+        item = self.items.get(port)
+        if item is None:
+            return
+        changed = {key: value for key, value in fields.items() if item[key] != value}
+        if not changed:
+            return
+        item.update(changed)
+        row = self.row(port)
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.HEADERS) - 1))
+
+    # 设备状态变化：done / failed 记为上次刷写结果，设备回到就绪状态
+    def set_status(self, port, status, detail=""):
+        if status in ("done", "failed"):
+            self.update_device(port, status=DEVICE_STATUS_TEXT["ready"],
+                               outcome=f"{DEVICE_STATUS_TEXT[status]} {datetime.now():%H:%M:%S}", detail=detail)
+        else:
+            self.update_device(port, status=DEVICE_STATUS_TEXT[status])
+
+    def selected_ports(self):
+        return [port for port in self.ports if self.items[port]["selected"]]
+
+    # 刷写期间禁止勾选
+    def set_enabled(self, enabled):
+        if self.enabled == enabled:
+            return
+        self.enabled = enabled
+        if self.ports:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.ports) - 1, len(self.HEADERS) - 1))
+
 # GUI 主窗口
 class MainWindow(QMainWindow):
-    def __init__(self, theme):
+    def __init__(self, theme, measure_startup=False):
         super().__init__()
         self.setWindowTitle("变色龙 Ultra 刷写工具")
         self.setGeometry(100, 100, 900, 700)
         self.setWindowFlags(Qt.FramelessWindowHint)
         self.setAttribute(Qt.WA_TranslucentBackground)
         self.setWindowIcon(QIcon('logo.ico'))
-        self.devices = {}
-        self.previous_states = {}
+        self.device_model = DeviceTableModel(self)
         self.running = False
-        self.detected_ports = set()
         self.device_detection_enabled = True
         self.is_flashing_finished = False
+        self.pending_ports = set()
+        self.detection_thread = None
+        self.worker = None
         self.theme = theme
+        self.measure_startup = measure_startup
+        self.startup_finished = False
         self.init_ui()
         self.debug_logger = DebugLoggerThread()
         self.debug_logger.start()
-        debug_signal.debug_message.connect(self.debug_text.append)
-        self.start_device_detection()
+        debug_signal.debug_message.connect(self.debug_text.appendPlainText)
+        self.port_watcher = None
+        self.time_check = None
+        self.time_check_thread = None
+        self.ledger = None
+        self.serial_allocator = None
+        self.metrics_server = None
+        self.station = None
+        self.station_signals = StationSignals()
+        self.station_signals.status.connect(self.on_station_status)
+        self.progress = ProgressAggregator()
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(int(1000 / PROGRESS_UPDATE_HZ))
+        self.progress_timer.timeout.connect(self.flush_progress)
+        # 长时间没有检测和刷写时，连接池中空闲超时的连接也要关闭
+        self.pool_timer = QTimer(self)
+        self.pool_timer.setInterval(int(connection_pool.idle_timeout * 1000 / 2))
+        self.pool_timer.timeout.connect(connection_pool.evict_idle)
+        self.pool_timer.start()
+        self.load_station_profile()
+
+    # 首帧绘制完成后再应用主题并启动设备检测
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.startup_finished:
+            self.startup_finished = True
+            mark_startup("first_frame")
+            QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        apply_theme(QApplication.instance(), self.theme)
+        mark_startup("theme")
+        self.refresh_time_check()
+        self.serial_allocator = make_serial_allocator(SERIAL_DB_PATH, SERIAL_STRATEGY, SERIAL_PREFIX)
+        if METRICS_PORT is not None:
+            try:
+                self.metrics_server = start_metrics_server(METRICS_PORT)
+            except OSError as e:
+                log_debug(f"指标服务启动失败: {str(e)}")
+        self.progress_timer.start()
+        self.port_watcher = PortWatcher()
+        self.port_watcher.ports_added.connect(self.on_ports_added)
+        self.port_watcher.ports_removed.connect(self.on_ports_removed)
+        self.port_watcher.start()
+        mark_startup("detection")
+        timings = {stage: round(elapsed * 1000, 1) for stage, elapsed in startup_marks}
+        log_debug(f"启动耗时(ms): {timings}")
+        if self.measure_startup:
+            print(json.dumps({"startup_ms": timings}))
+            self.close()
 
     def init_ui(self):
         central_widget = QWidget()
@@ -568,9 +750,14 @@ class MainWindow(QMainWindow):
         shadow.setOffset(0, 0)
         content_widget.setGraphicsEffect(shadow)
 
-        self.device_layout = QVBoxLayout()
+        self.device_table = QTableView()
+        self.device_table.setModel(self.device_model)
+        self.device_table.setSelectionMode(QTableView.NoSelection)
+        self.device_table.verticalHeader().hide()
+        self.device_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.device_table.setMinimumHeight(120)
         content_layout.addWidget(QLabel("可用 ChameleonUltra 设备:"))
-        content_layout.addLayout(self.device_layout)
+        content_layout.addWidget(self.device_table)
 
         config_widget = QWidget()
         config_layout = QHBoxLayout(config_widget)
@@ -592,9 +779,22 @@ class MainWindow(QMainWindow):
         config_layout.addWidget(QLabel("按亮循环:"))
         config_layout.addWidget(self.light_toggle)
 
+        self.differential_toggle = ToggleButton("仅发送变化项", self.theme)
+        config_layout.addWidget(QLabel("仅发送变化项:"))
+        config_layout.addWidget(self.differential_toggle)
+
         content_layout.addWidget(QLabel("配置选项:"))
         content_layout.addWidget(config_widget)
 
+        station_widget = QWidget()
+        station_layout = QHBoxLayout(station_widget)
+        self.station_toggle = ToggleButton("无人值守模式", self.theme)
+        self.station_toggle.clicked.connect(self.toggle_station_mode)
+        station_layout.addWidget(QLabel("无人值守模式（插入即刷写）:"))
+        station_layout.addWidget(self.station_toggle)
+        station_layout.addStretch()
+        content_layout.addWidget(station_widget)
+
         self.start_button = QPushButton("开始刷写")
         self.start_button.setObjectName("startButton")
         self.start_button.clicked.connect(self.start_flashing)
@@ -612,8 +812,9 @@ class MainWindow(QMainWindow):
         content_layout.addWidget(QLabel("执行结果:"))
         content_layout.addWidget(self.result_text)
 
-        self.debug_text = QTextEdit()
+        self.debug_text = QPlainTextEdit()
         self.debug_text.setReadOnly(True)
+        self.debug_text.setMaximumBlockCount(DEBUG_VIEW_MAX_LINES)
         content_layout.addWidget(QLabel("调试信息:"))
         content_layout.addWidget(self.debug_text)
 
@@ -662,69 +863,92 @@ class MainWindow(QMainWindow):
                 }
             """)
 
+    def on_ports_added(self, ports):
+        self.pending_ports.update(ports)
+        self.start_device_detection()
+
+    def on_ports_removed(self, ports):
+        self.pending_ports.difference_update(ports)
+        for port in ports:
+            probe_cache.invalidate(port)
+            connection_pool.evict(port)
+            if self.station is not None:
+                self.station.forget(port)
+        self.remove_devices(ports)
+
+    # 只探测新出现的串口；刷写期间或已有检测在运行时先记下，稍后再探测
     def start_device_detection(self):
         if not self.device_detection_enabled:
-            log_debug("设备检测已暂停")
+            log_debug("设备检测已暂停，等待刷写完成")
+            return
+        if self.detection_thread is not None or not self.pending_ports:
             return
-        self.detection_thread = DeviceDetectionThread()
-        self.detection_thread.device_detected.connect(self.update_device_list)
+        ports = sorted(self.pending_ports)
+        self.pending_ports.clear()
+        if IO_BACKEND == "asyncio":
+            self.detection_thread = AsyncDeviceDetectionThread(ports)
+        else:
+            self.detection_thread = DeviceDetectionThread(ports)
         self.detection_thread.device_update.connect(self.update_device_list_realtime)
         self.detection_thread.finished.connect(self.on_detection_finished)
         self.detection_thread.start()
 
     def on_detection_finished(self):
         self.detection_thread.deleteLater()
-        self.schedule_next_detection()
+        self.detection_thread = None
+        self.start_device_detection()
 
-    def schedule_next_detection(self):
-        if not self.running and self.device_detection_enabled:
-            QTimer.singleShot(2000, self.start_device_detection)
-        else:
-            log_debug("设备检测暂停，等待刷写完成")
-
-    def update_device_list_realtime(self, port, is_chameleon):
-        if is_chameleon:
-            if port not in self.detected_ports:
-                self.detected_ports.add(port)
-                device_name = f"Chameleon Ultra - {port}"
-                checkbox = QCheckBox(device_name)
-                if port in self.previous_states:
-                    checkbox.setChecked(self.previous_states[port]["selected"])
-                self.device_layout.addWidget(checkbox)
-                self.devices[port] = {"checkbox": checkbox}
-                log_debug(f"实时添加设备: {port}")
-
-    def update_device_list(self, ports):
-        log_debug(f"最终更新设备列表: {ports}")
-        for port, info in self.devices.items():
-            self.previous_states[port] = {
-                "selected": info["checkbox"].isChecked()
-            }
-
-        for i in reversed(range(self.device_layout.count())):
-            self.device_layout.itemAt(i).widget().deleteLater()
-
-        self.devices.clear()
-        self.detected_ports.clear()
+    def update_device_list_realtime(self, port, is_chameleon, firmware):
+        if not is_chameleon:
+            return
+        if not self.device_model.add_device(port, firmware):
+            if firmware:
+                self.device_model.update_device(port, firmware=firmware)
+            return
+        log_debug(f"实时添加设备: {port}")
+        if self.station is not None:
+            self.station.submit(port)
+
+    def remove_devices(self, ports):
         for port in ports:
-            self.detected_ports.add(port)
-            device_name = f"Chameleon Ultra - {port}"
-            checkbox = QCheckBox(device_name)
-            if port in self.previous_states:
-                checkbox.setChecked(self.previous_states[port]["selected"])
-            self.device_layout.addWidget(checkbox)
-            self.devices[port] = {"checkbox": checkbox}
-        log_debug(f"设备列表更新完成，显示设备: {list(self.devices.keys())}")
+            if self.device_model.remove_device(port):
+                log_debug(f"移除设备: {port}")
+
+    # 在后台刷新时间校验结果，已有校验在进行时不重复启动
+    def refresh_time_check(self):
+        if self.time_check_thread is not None:
+            return
+        self.time_check_thread = TimeCheckThread()
+        self.time_check_thread.checked.connect(self.on_time_checked)
+        self.time_check_thread.finished.connect(self.on_time_check_finished)
+        self.time_check_thread.start()
+
+    def on_time_checked(self, valid, message):
+        self.time_check = (valid, message, time.monotonic())
+
+    def on_time_check_finished(self):
+        self.time_check_thread.deleteLater()
+        self.time_check_thread = None
+
+    # 返回缓存的时间校验结果，从不阻塞；结果缺失或过期时在后台刷新
+    def cached_time_check(self):
+        if self.time_check is None:
+            self.refresh_time_check()
+            return True, "时间校验尚未完成，跳过版本校验"
+        valid, message, checked_at = self.time_check
+        if time.monotonic() - checked_at > NTP_CACHE_TTL:
+            self.refresh_time_check()
+        return valid, message
 
     def start_flashing(self):
         log_debug("开始刷写按钮点击")
-        valid, message = check_time()
+        valid, message = self.cached_time_check()
         if not valid:
             log_debug(f"时间校验失败: {message}")
             QMessageBox.critical(self, "错误", message)
             return
 
-        selected_devices = [port for port, info in self.devices.items() if info["checkbox"].isChecked()]
+        selected_devices = self.device_model.selected_ports()
         log_debug(f"选中的设备: {selected_devices}")
         if not selected_devices:
             log_debug("未选择任何设备")
@@ -735,7 +959,8 @@ class MainWindow(QMainWindow):
             "firmware": self.firmware_toggle.state(),
             "low_freq": self.low_freq_toggle.state(),
             "high_freq": self.high_freq_toggle.state(),
-            "light": self.light_toggle.state()
+            "light": self.light_toggle.state(),
+            "differential": self.differential_toggle.state()
         }
         log_debug(f"配置选项: {settings}")
 
@@ -744,23 +969,28 @@ class MainWindow(QMainWindow):
         #    QMessageBox.warning(self, "警告", "请至少启用一个配置选项")
         #    return
 
+        # 只有写入固件时才从序列号库中分配，避免空耗序列号
         serial_numbers = {}
-        for port in selected_devices:
-            sn_cmd, sn = generate_serial_number_command()
-            serial_numbers[port] = (sn_cmd, sn)
-            self.result_text.append(f"设备 {port} 的新序列号: {sn}")
+        if settings["firmware"]:
+            try:
+                for port in selected_devices:
+                    serial_numbers[port] = generate_serial_number_command(self.serial_allocator)
+            except RuntimeError as e:
+                log_debug(f"序列号分配失败: {str(e)}")
+                QMessageBox.critical(self, "错误", str(e))
+                return
 
         self.running = True
         self.device_detection_enabled = False
         self.is_flashing_finished = False
         log_debug("暂停设备检测")
         self.start_button.setEnabled(False)
-        for port, info in self.devices.items():
-            info["checkbox"].setEnabled(False)
+        self.device_model.set_enabled(False)
         self.firmware_toggle.setEnabled(False)
         self.low_freq_toggle.setEnabled(False)
         self.high_freq_toggle.setEnabled(False)
         self.light_toggle.setEnabled(False)
+        self.differential_toggle.setEnabled(False)
         log_debug("禁用设备选择和配置选项")
 
         QMessageBox.warning(self, "警告", "请勿关闭窗口或移除设备，否则可能导致设备损坏！")
@@ -768,19 +998,25 @@ class MainWindow(QMainWindow):
         self.result_text.clear()
         self.debug_text.clear()
         self.progress_bar.setValue(0)
+        self.progress.snapshot()
+        command_metrics.reset()
         log_debug("清空输出和进度条")
 
-        for port in selected_devices:
-            _, sn = serial_numbers[port]
+        for port, (_, sn) in serial_numbers.items():
             self.result_text.append(f"设备 {port} 的新序列号: {sn}")
 
         try:
             log_debug("启动 WorkerThread")
-            self.worker = WorkerThread(selected_devices, settings, serial_numbers)
-            self.worker.update_progress.connect(self.progress_bar.setValue)
-            self.worker.update_task.connect(self.current_task_label.setText)
-            self.worker.update_result.connect(self.result_text.append)
-            self.worker.update_debug.connect(self.debug_text.append)
+            if IO_BACKEND == "asyncio":
+                self.worker = AsyncWorkerThread(selected_devices, settings, serial_numbers, ASYNC_MAX_INFLIGHT,
+                                                PIPELINE_WINDOW, self.open_ledger(), self.progress)
+            elif IO_BACKEND == "process":
+                self.worker = ShardedWorkerThread(selected_devices, settings, serial_numbers, SHARD_PROCESSES,
+                                                  MAX_CONCURRENT_DEVICES, PIPELINE_WINDOW, self.open_ledger(),
+                                                  self.progress)
+            else:
+                self.worker = WorkerThread(selected_devices, settings, serial_numbers, MAX_CONCURRENT_DEVICES,
+                                           PIPELINE_WINDOW, self.open_ledger(), self.progress)
             self.worker.error_occurred.connect(self.on_error_occurred)
             self.worker.finished.connect(self.on_flashing_finished)
             self.worker.start()
@@ -790,6 +1026,8 @@ class MainWindow(QMainWindow):
             self.on_flashing_finished()
 
     def on_error_occurred(self, errors):
+        # 先取走剩余的结果，错误汇总排在全部结果之后
+        self.flush_progress()
         if errors:
             error_message = "以下错误发生:\n" + "\n".join(errors)
             self.result_text.append(f"错误汇总:\n{error_message}")
@@ -800,6 +1038,7 @@ class MainWindow(QMainWindow):
             log_debug("on_flashing_finished 已执行，忽略重复调用")
             return
         self.is_flashing_finished = True
+        self.flush_progress()
         log_debug("刷写完成或错误退出")
         self.running = False
         self.device_detection_enabled = True
@@ -811,18 +1050,15 @@ class MainWindow(QMainWindow):
             log_debug("开始按钮已启用")
 
             # 启用设备选择
-            for port, info in self.devices.items():
-                try:
-                    info["checkbox"].setEnabled(True)
-                    log_debug(f"设备 {port} 的选择框已启用")
-                except Exception as e:
-                    log_debug(f"启用设备 {port} 选择框失败: {str(e)}")
+            self.device_model.set_enabled(True)
+            log_debug("设备选择已启用")
 
             # 启用配置选项
             self.firmware_toggle.setEnabled(True)
             self.low_freq_toggle.setEnabled(True)
             self.high_freq_toggle.setEnabled(True)
             self.light_toggle.setEnabled(True)
+            self.differential_toggle.setEnabled(True)
             log_debug("所有配置选项已启用")
 
         except Exception as e:
@@ -835,16 +1071,172 @@ class MainWindow(QMainWindow):
             log_debug(f"断开信号失败: {str(e)}")
 
         self.worker.deleteLater()
+        self.worker = None
+        self.report_metrics()
         self.start_device_detection()
 
+    # 把聚合器中的变化一次性应用到界面：每帧最多一次进度条、任务标签和结果区更新
+    def flush_progress(self):
+        snapshot = self.progress.snapshot()
+        if snapshot["progress"] is not None:
+            self.progress_bar.setValue(snapshot["progress"])
+        if snapshot["task"] is not None:
+            self.current_task_label.setText(snapshot["task"])
+        if snapshot["results"]:
+            self.result_text.append("\n".join(snapshot["results"]))
+        for port, status in snapshot["devices"].items():
+            self.device_model.set_status(port, status)
+
+    # 输出本次刷写的命令延迟摘要
+    def report_metrics(self):
+        try:
+            if METRICS_JSON_PATH:
+                summary = save_metrics_summary(METRICS_JSON_PATH)
+            else:
+                summary = command_metrics.summary()
+            log_debug(f"命令延迟摘要: {json.dumps(summary['commands'], ensure_ascii=False)}")
+        except Exception as e:
+            log_debug(f"保存命令延迟摘要失败: {str(e)}")
+
+    # 恢复上次无人值守模式使用的配置
+    def load_station_profile(self):
+        try:
+            with open(STATION_PROFILE_PATH, encoding="utf-8") as f:
+                profile = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log_debug(f"读取无人值守配置失败: {str(e)}")
+            return
+        self.firmware_toggle.set_state(bool(profile.get("firmware")))
+        self.low_freq_toggle.set_state(bool(profile.get("low_freq")))
+        self.high_freq_toggle.set_state(bool(profile.get("high_freq")))
+        self.light_toggle.set_state(bool(profile.get("light")))
+        self.differential_toggle.set_state(bool(profile.get("differential")))
+        log_debug(f"已恢复无人值守配置: {profile}")
+
+    def save_station_profile(self, settings):
+        try:
+            with open(STATION_PROFILE_PATH, "w", encoding="utf-8") as f:
+                json.dump(settings, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            log_debug(f"保存无人值守配置失败: {str(e)}")
+
+    def set_controls_enabled(self, enabled):
+        self.start_button.setEnabled(enabled)
+        self.firmware_toggle.setEnabled(enabled)
+        self.low_freq_toggle.setEnabled(enabled)
+        self.high_freq_toggle.setEnabled(enabled)
+        self.light_toggle.setEnabled(enabled)
+        self.differential_toggle.setEnabled(enabled)
+
+    # 无人值守模式：设备检测保持运行，新检测到的设备立即按保存的配置刷写
+    def toggle_station_mode(self):
+        if not self.station_toggle.state():
+            self.stop_station()
+            return
+        if self.running:
+            self.station_toggle.set_state(False)
+            QMessageBox.warning(self, "警告", "请等待当前刷写完成后再开启无人值守模式")
+            return
+        valid, message = self.cached_time_check()
+        if not valid:
+            self.station_toggle.set_state(False)
+            QMessageBox.critical(self, "错误", message)
+            return
+
+        settings = {
+            "firmware": self.firmware_toggle.state(),
+            "low_freq": self.low_freq_toggle.state(),
+            "high_freq": self.high_freq_toggle.state(),
+            "light": self.light_toggle.state(),
+            "differential": self.differential_toggle.state()
+        }
+        self.save_station_profile(settings)
+        self.station = FlashStation(settings, self.station_report, self.station_signals.status.emit,
+                                    self.serial_allocator, self.open_ledger(), MAX_CONCURRENT_DEVICES,
+                                    PIPELINE_WINDOW)
+        self.set_controls_enabled(False)
+        self.current_task_label.setText("当前执行项目: 无人值守模式，等待设备接入")
+        log_debug(f"开启无人值守模式，配置: {settings}")
+
+    def stop_station(self):
+        if self.station is None:
+            return
+        # 在途的刷写在后台继续完成，不阻塞界面
+        self.station.close(wait=False)
+        self.station = None
+        self.flush_progress()
+        self.set_controls_enabled(True)
+        self.current_task_label.setText("当前执行项目: 无")
+        log_debug("关闭无人值守模式")
+
+    # 工位线程池中调用：只转发结果和调试信息，单台设备的进度不显示
+    def station_report(self, kind, value):
+        if kind in ("result", "debug"):
+            self.progress.report(kind, value)
+
+    def on_station_status(self, port, status, detail):
+        self.flush_progress()
+        self.device_model.set_status(port, status, detail if status == "failed" else "")
+        if status == "done":
+            self.result_text.append(f"设备 {port} 刷写完成" + (f"，新序列号: {detail}" if detail else ""))
+        elif status == "failed":
+            self.result_text.append(f"设备 {port} 刷写失败: {detail}")
+        if self.station is not None:
+            counts = self.station.counts
+            self.current_task_label.setText(
+                f"当前执行项目: 无人值守模式，已完成 {counts['done']} 台，失败 {counts['failed']} 台")
+
+    # 首次刷写时才打开刷写记录账本；打开失败只记日志，不影响刷写
+    def open_ledger(self):
+        if self.ledger is None and LEDGER_PATH:
+            try:
+                self.ledger = FlashLedger(LEDGER_PATH)
+            except Exception as e:
+                log_debug(f"打开刷写记录失败: {str(e)}")
+        return self.ledger
+
     def closeEvent(self, event):
+        # 关闭后不再启动新的检测（热插拔信号可能已在队列中）
+        self.device_detection_enabled = False
+        if self.port_watcher is not None:
+            self.port_watcher.stop()
+        # 检测和时间校验线程都有超时，等它们结束后再退出，避免退出时线程仍在运行
+        for thread in (self.detection_thread, self.time_check_thread):
+            if thread is not None:
+                thread.wait()
+        # 刷写中关闭：等工作线程写完刷写记录后再关闭 ledger，否则之后入队的记录会丢失；
+        # 先断开完成信号，避免关闭后再恢复设备检测。asyncio 引擎取消在途命令，不必等全部设备刷完
+        if self.worker is not None:
+            self.worker.finished.disconnect(self.on_flashing_finished)
+            self.worker.error_occurred.disconnect(self.on_error_occurred)
+            if isinstance(self.worker, AsyncWorkerThread):
+                self.worker.cancel()
+            self.worker.wait()
+        if self.station is not None:
+            self.station.close()
+        connection_pool.close_all()
+        if self.ledger is not None:
+            self.ledger.close()
+        if self.serial_allocator is not None:
+            self.serial_allocator.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
         self.debug_logger.stop()
         event.accept()
 
 if __name__ == "__main__":
+    # 打包为可执行文件时，多进程分片的子进程从这里启动
+    import multiprocessing
+    multiprocessing.freeze_support()
+    # --startup-time: 输出各启动阶段耗时（JSON）后退出，用于跟踪冷启动耗时
+    measure_startup = "--startup-time" in sys.argv
+    mark_startup("imports")
     app = QApplication(sys.argv)
+    mark_startup("qapplication")
     theme = darkdetect.theme().lower() if darkdetect.theme() else "light"
-    apply_stylesheet(app, theme='dark_teal.xml' if theme == "dark" else 'light_blue.xml')
-    window = MainWindow(theme)
+    window = MainWindow(theme, measure_startup)
+    mark_startup("window")
     window.show()
     sys.exit(app.exec())
\ No newline at end of file
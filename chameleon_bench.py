@@ -0,0 +1,206 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import platform
+import threading
+import chameleon_core
+from chameleon_core import (
+    detect_chameleon_ports, generate_serial_number_command, FlashJob, AsyncFlashEngine, ShardedFlashJob
+)
+from chameleon_sim import ChameleonSimulator
+
+# 检测与刷写吞吐量基准测试：在 chameleon_sim 模拟的设备上测量不同设备数、命令延迟和超时配置下的
+# 检测耗时、单台刷写耗时、每分钟刷写台数、CPU 时间和线程数，结果为 JSONL，便于和基线比较
+# 例: python chameleon_bench.py --devices 1 16 64 256 --latency 0 0.005 --output bench.jsonl
+#     python chameleon_bench.py --baseline bench.jsonl   # 吞吐量低于基线超过容差时返回 1
+
+BENCH_SETTINGS = {"firmware": True, "low_freq": True, "high_freq": True, "light": True}
+
+# 基准运行期间在每个线程开始和结束时计数，记录同时存活线程数的峰值；
+# 定时采样会漏掉两次采样之间启动又结束的短命工作线程
+class ThreadCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = threading.active_count()
+        self.peak = self.active
+        self.original_run = None
+
+    def change(self, delta):
+        with self.lock:
+            self.active += delta
+            self.peak = max(self.peak, self.active)
+
+    def __enter__(self):
+        counter = self
+        original_run = self.original_run = threading.Thread.run
+
+        def run(thread):
+            counter.change(1)
+            try:
+                original_run(thread)
+            finally:
+                counter.change(-1)
+
+        threading.Thread.run = run
+        return self
+
+    def __exit__(self, *exc):
+        threading.Thread.run = self.original_run
+
+# 本进程和已结束子进程的 CPU 时间之和
+def cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(entry.ru_utime + entry.ru_stime for entry in usage)
+
+# 代替刷写记录账本收集每台设备的记录，用于计算单台刷写耗时
+class RecordCollector:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# 测量一段代码的墙钟时间、CPU 时间（含子进程）和峰值线程数
+def measure(func):
+    cpu_started = cpu_time()
+    started = time.perf_counter()
+    with ThreadCounter() as counter:
+        result = func()
+    return result, {
+        "wall": time.perf_counter() - started,
+        "cpu": cpu_time() - cpu_started,
+        "threads": counter.peak,
+    }
+
+# 单个配置的一次基准：启动模拟器、检测全部设备、刷写全部设备
+def run_case(devices, latency, args):
+    simulator = ChameleonSimulator(devices, latency, args.jitter, seed=args.seed)
+    ports = simulator.start()
+    chameleon_core.EXTRA_PORTS[:] = ports
+    try:
+        detected, detection = measure(lambda: detect_chameleon_ports(ports, max_workers=args.max_workers))
+        found = [port for port, is_chameleon, _ in detected if is_chameleon]
+
+        serial_numbers = {port: generate_serial_number_command() for port in ports}
+        collector = RecordCollector()
+        if args.backend == "asyncio":
+            engine = AsyncFlashEngine(ports, BENCH_SETTINGS, serial_numbers, lambda kind, value: None,
+                                      args.max_inflight, args.pipeline, collector)
+            errors, flashing = measure(lambda: asyncio.run(engine.run()))
+        elif args.backend == "process":
+            job = ShardedFlashJob(ports, BENCH_SETTINGS, serial_numbers, lambda kind, value: None,
+                                  args.processes, args.max_workers, args.pipeline, collector)
+            errors, flashing = measure(job.run)
+        else:
+            job = FlashJob(ports, BENCH_SETTINGS, serial_numbers, lambda kind, value: None,
+                           args.max_workers, args.pipeline, collector)
+            errors, flashing = measure(job.run)
+    finally:
+        chameleon_core.connection_pool.close_all()
+        simulator.stop()
+        chameleon_core.EXTRA_PORTS[:] = []
+
+    durations = [record["finished_at"] - record["started_at"] for record in collector.records]
+    return {
+        "case": f"{args.backend}/devices={devices}/latency={latency}/timeout={args.timeout}/pipeline={args.pipeline}",
+        "backend": args.backend,
+        "devices": devices,
+        "latency": latency,
+        "jitter": args.jitter,
+        "timeout": args.timeout,
+        "pipeline": args.pipeline,
+        "detected": len(found),
+        "detection_seconds": round(detection["wall"], 4),
+        "detection_cpu_seconds": round(detection["cpu"], 4),
+        "detection_threads": detection["threads"],
+        "flash_seconds": round(flashing["wall"], 4),
+        "flash_cpu_seconds": round(flashing["cpu"], 4),
+        "flash_threads": flashing["threads"],
+        "device_flash_p50": round(percentile(durations, 0.5) or 0, 4),
+        "device_flash_p95": round(percentile(durations, 0.95) or 0, 4),
+        "devices_per_minute": round(devices / flashing["wall"] * 60, 1) if flashing["wall"] else None,
+        "errors": len(errors),
+    }
+
+# 读取基线文件，同一用例以最后一次结果为准
+def load_baseline(path):
+    with open(path) as f:
+        return {entry["case"]: entry for entry in map(json.loads, filter(str.strip, f)) if "case" in entry}
+
+# 与基线比较吞吐量，返回退化的用例列表
+def compare_baseline(results, baseline, tolerance):
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["case"])
+        if not previous or not previous.get("devices_per_minute") or result["devices_per_minute"] is None:
+            continue
+        if result["devices_per_minute"] < previous["devices_per_minute"] * (1 - tolerance):
+            regressions.append({"case": result["case"], "baseline": previous["devices_per_minute"],
+                                "current": result["devices_per_minute"]})
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="变色龙 Ultra 检测与刷写基准测试")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 4, 16, 64, 256], help="模拟设备数")
+    parser.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.005], help="模拟应答延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟应答延迟抖动（秒）")
+    parser.add_argument("--timeout", type=float, default=chameleon_core.COMMAND_TIMEOUT,
+                        help="单条命令的响应超时（秒）")
+    parser.add_argument("--backend", choices=["thread", "asyncio", "process"], default="thread", help="I/O 后端")
+    parser.add_argument("--processes", type=int, default=chameleon_core.SHARD_PROCESSES,
+                        help="process 后端的子进程数")
+    parser.add_argument("--max-workers", type=int, default=chameleon_core.MAX_CONCURRENT_DEVICES,
+                        help="thread 后端同时刷写的设备数")
+    parser.add_argument("--max-inflight", type=int, default=chameleon_core.ASYNC_MAX_INFLIGHT,
+                        help="asyncio 后端同时在途的命令数")
+    parser.add_argument("--pipeline", type=int, default=chameleon_core.PIPELINE_WINDOW,
+                        help="一次连续发送的独立命令数")
+    parser.add_argument("--seed", type=int, default=0, help="模拟器随机种子")
+    parser.add_argument("--output", help="结果追加写入的 JSONL 文件，默认输出到 stdout")
+    parser.add_argument("--baseline", help="基线 JSONL 文件，吞吐量退化超过容差时返回 1")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的吞吐量下降比例")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    chameleon_core.debug_handlers[:] = []
+    chameleon_core.COMMAND_TIMEOUT = args.timeout
+    # 先读基线，--output 与 --baseline 为同一文件时不会和本次结果比较
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    out = open(args.output, "a") if args.output else sys.stdout
+    results = []
+    try:
+        out.write(json.dumps({"event": "environment", "python": platform.python_version(),
+                              "platform": platform.platform(), "time": round(time.time(), 3)}) + "\n")
+        for latency in args.latency:
+            for devices in args.devices:
+                result = run_case(devices, latency, args)
+                results.append(result)
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if baseline is not None:
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(json.dumps({"event": "regression", **regression}), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+import chameleon_core
+from chameleon_core import (
+    log_debug, generate_serial_number_command, detect_chameleon_ports,
+    FlashJob, AsyncFlashEngine, FlashLedger, MAX_CONCURRENT_DEVICES, ASYNC_MAX_INFLIGHT,
+    PIPELINE_WINDOW, LEDGER_PATH, make_serial_allocator, SERIAL_DB_PATH, SERIAL_STRATEGY, SERIAL_PREFIX,
+    command_metrics, start_metrics_server, save_metrics_summary, connection_pool,
+    ShardedFlashJob, detect_chameleon_ports_sharded, SHARD_PROCESSES,
+    settings_profile, load_flash_profile, list_flash_profiles, compile_flash_plan
+)
+
+# 命令行批量刷写工具，不依赖 Qt，可在无图形界面的 Linux 上运行
+# 例: python chameleon_cli.py --all --firmware --low-freq on --light off
+#     python chameleon_cli.py --all --profile factory   # 使用 profiles/factory.json
+
+# 时间参数: Unix 时间戳或 ISO 格式日期时间
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+# 开关类配置项: on / off / 不设置
+def parse_toggle(value):
+    if value is None:
+        return None
+    return value == "on"
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="变色龙 Ultra 命令行刷写工具")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--ports", nargs="+", metavar="PORT", help="要刷写的串口")
+    target.add_argument("--all", action="store_true", help="刷写检测到的全部 ChameleonUltra")
+    target.add_argument("--lookup-serial", metavar="SN", help="在刷写记录中按序列号查询")
+    target.add_argument("--lookup-range", nargs=2, metavar=("FROM", "TO"), type=parse_time,
+                        help="在刷写记录中按开始时间范围查询")
+    target.add_argument("--list-profiles", action="store_true", help="列出可用的刷写配置")
+    parser.add_argument("--profile", metavar="NAME|PATH",
+                        help="按刷写配置文件（JSON/YAML）刷写，忽略 --firmware 和各开关参数")
+    parser.add_argument("--firmware", action="store_true", help="固件激活并写入新序列号")
+    parser.add_argument("--serial-db", default=SERIAL_DB_PATH, help="已发放序列号数据库路径")
+    parser.add_argument("--serial-strategy", choices=["random", "sequential"], default=SERIAL_STRATEGY,
+                        help="序列号分配策略")
+    parser.add_argument("--serial-prefix", default=SERIAL_PREFIX, help="sequential 策略的序列号前缀")
+    parser.add_argument("--differential", action="store_true",
+                        help="差异模式：先读取设备当前状态，只发送会改变状态的命令")
+    parser.add_argument("--low-freq", choices=["on", "off"], help="低频ID循环")
+    parser.add_argument("--high-freq", choices=["on", "off"], help="高频IC循环")
+    parser.add_argument("--light", choices=["on", "off"], help="按亮循环")
+    parser.add_argument("--backend", choices=["thread", "asyncio", "process"], default="thread",
+                        help="I/O 后端，process 为把设备分给多个子进程")
+    parser.add_argument("--processes", type=int, default=SHARD_PROCESSES, help="process 后端的子进程数")
+    parser.add_argument("--max-workers", type=int, default=MAX_CONCURRENT_DEVICES,
+                        help="thread 后端同时刷写的设备数")
+    parser.add_argument("--max-inflight", type=int, default=ASYNC_MAX_INFLIGHT,
+                        help="asyncio 后端同时在途的命令数")
+    parser.add_argument("--pipeline", type=int, default=PIPELINE_WINDOW,
+                        help="一次连续发送的独立命令数，1 为严格逐条收发")
+    parser.add_argument("--timeout", type=float, default=chameleon_core.COMMAND_TIMEOUT,
+                        help="单条命令的响应超时（秒）")
+    parser.add_argument("--ledger", default=LEDGER_PATH, help="刷写记录数据库路径")
+    parser.add_argument("--no-ledger", action="store_true", help="不写刷写记录")
+    parser.add_argument("--metrics-port", type=int, help="在本地该端口以 Prometheus 格式导出命令延迟指标")
+    parser.add_argument("--metrics-json", metavar="PATH", help="运行结束后把命令延迟摘要写入该 JSON 文件")
+    parser.add_argument("--detect-only", action="store_true", help="只检测设备，不刷写")
+    parser.add_argument("--format", choices=["jsonl", "text"], default="jsonl", help="输出格式")
+    parser.add_argument("--verbose", action="store_true", help="把调试日志输出到 stderr")
+    return parser
+
+# 输出一条事件，jsonl 格式每行一个 JSON 对象
+class EventWriter:
+    def __init__(self, fmt, stream=None):
+        self.fmt = fmt
+        self.stream = stream or sys.stdout
+
+    def write(self, event, **fields):
+        if self.fmt == "jsonl":
+            record = {"event": event, "time": round(time.time(), 3)}
+            record.update(fields)
+            self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            self.stream.write(f"[{event}] " + " ".join(f"{key}={value}" for key, value in fields.items()) + "\n")
+        self.stream.flush()
+
+# 运行结束时输出命令延迟摘要
+def write_metrics(out, args):
+    if args.metrics_json:
+        summary = save_metrics_summary(args.metrics_json)
+    else:
+        summary = command_metrics.summary()
+    out.write("metrics", **summary)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        chameleon_core.debug_handlers[:] = [lambda message: print(f"[DEBUG] {message}", file=sys.stderr)]
+    else:
+        chameleon_core.debug_handlers[:] = []
+    chameleon_core.COMMAND_TIMEOUT = args.timeout
+    out = EventWriter(args.format)
+    started = time.monotonic()
+    metrics_server = start_metrics_server(args.metrics_port) if args.metrics_port is not None else None
+    try:
+        return run(args, out, started)
+    finally:
+        connection_pool.close_all()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+def run(args, out, started):
+
+    if args.lookup_serial or args.lookup_range:
+        ledger = FlashLedger(args.ledger)
+        if args.lookup_serial:
+            records = ledger.find_by_serial_number(args.lookup_serial)
+        else:
+            records = ledger.find_by_time(*args.lookup_range)
+        ledger.close()
+        for record in records:
+            out.write("record", **record)
+        out.write("summary", records=len(records), elapsed=round(time.monotonic() - started, 3))
+        return 0
+
+    if args.list_profiles:
+        for name in list_flash_profiles():
+            out.write("profile", name=name)
+        return 0
+
+    # 先编译刷写计划，配置有误时不做检测
+    if args.profile:
+        try:
+            plan = compile_flash_plan(load_flash_profile(args.profile), args.pipeline)
+        except (OSError, ValueError) as e:
+            out.write("summary", ports=[], errors=[str(e)], elapsed=round(time.monotonic() - started, 3))
+            return 2
+        settings = {"profile": plan.name, "differential": args.differential}
+    else:
+        settings = {
+            "firmware": args.firmware,
+            "low_freq": parse_toggle(args.low_freq),
+            "high_freq": parse_toggle(args.high_freq),
+            "light": parse_toggle(args.light),
+            "differential": args.differential,
+        }
+        plan = compile_flash_plan(settings_profile(settings), args.pipeline)
+
+    if args.all:
+        on_result = lambda port, is_chameleon, message: out.write(
+            "detect", port=port, chameleon=is_chameleon, message=message)
+        if args.backend == "process":
+            results = detect_chameleon_ports_sharded(processes=args.processes, max_workers=args.max_workers,
+                                                     on_result=on_result)
+        else:
+            results = detect_chameleon_ports(max_workers=args.max_workers, on_result=on_result)
+        ports = sorted(port for port, is_chameleon, _ in results if is_chameleon)
+    else:
+        ports = args.ports
+    if args.detect_only:
+        write_metrics(out, args)
+        if not ports:
+            out.write("summary", ports=[], errors=["未找到可刷写的设备"], elapsed=round(time.monotonic() - started, 3))
+            return 2
+        out.write("summary", ports=ports, elapsed=round(time.monotonic() - started, 3))
+        return 0
+    if not ports:
+        out.write("summary", ports=[], errors=["未找到可刷写的设备"], elapsed=round(time.monotonic() - started, 3))
+        return 2
+
+    log_debug(f"配置选项: {settings}")
+
+    serial_numbers = {}
+    if plan.needs_serial_number:
+        allocator = make_serial_allocator(args.serial_db, args.serial_strategy, args.serial_prefix)
+        try:
+            for port in ports:
+                serial_numbers[port] = generate_serial_number_command(allocator)
+                out.write("serial_number", port=port, serial_number=serial_numbers[port][1])
+        except RuntimeError as e:
+            out.write("summary", ports=ports, errors=[str(e)], elapsed=round(time.monotonic() - started, 3))
+            return 2
+        finally:
+            allocator.close()
+
+    def report(kind, value):
+        if kind != "debug" or args.verbose:
+            out.write(kind, value=value)
+
+    ledger = None if args.no_ledger else FlashLedger(args.ledger)
+    try:
+        if args.backend == "asyncio":
+            engine = AsyncFlashEngine(ports, settings, serial_numbers, report, args.max_inflight,
+                                      args.pipeline, ledger, plan)
+            errors = asyncio.run(engine.run())
+        elif args.backend == "process":
+            errors = ShardedFlashJob(ports, settings, serial_numbers, report, args.processes, args.max_workers,
+                                     args.pipeline, ledger, plan).run()
+        else:
+            errors = FlashJob(ports, settings, serial_numbers, report, args.max_workers,
+                              args.pipeline, ledger, plan).run()
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+    write_metrics(out, args)
+    out.write("summary", ports=ports, errors=errors, elapsed=round(time.monotonic() - started, 3))
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
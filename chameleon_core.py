@@ -0,0 +1,2312 @@
+import os
+import time
+import json
+import math
+import bisect
+import queue
+import string
+import struct
+import hashlib
+import secrets
+import threading
+import asyncio
+import contextlib
+import logging
+import logging.handlers
+import sqlite3
+import serial
+import types
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+try:
+    import crcmod.predefined
+    crcmod_fast = crcmod.predefined.mkCrcFun('modbus')
+except ImportError:
+    crcmod_fast = None
+
+# 调试日志环形缓冲区的容量，写满后丢弃最旧的日志
+DEBUG_BUFFER_SIZE = 10000
+
+# 有界的调试日志缓冲区，由界面的 DebugLoggerThread 定期整批取走
+class DebugLogBuffer:
+    def __init__(self, maxlen=DEBUG_BUFFER_SIZE):
+        self.lines = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def append(self, message):
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(message)
+
+    # 取走全部缓存的日志，返回 (日志列表, 上次取走后被丢弃的条数)
+    def drain(self):
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
+
+debug_buffer = DebugLogBuffer()
+
+# 调试日志的输出目标，命令行模式下会替换为打印到 stderr 或直接丢弃
+debug_handlers = [debug_buffer.append]
+
+# 调试日志函数
+def log_debug(message):
+    for handler in debug_handlers:
+        handler(message)
+
+# 按大小滚动的调试日志文件，返回写入用的 logger
+def open_debug_log_file(path, max_bytes=5 * 1024 * 1024, backup_count=3):
+    logger = logging.getLogger("chameleon.debug")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+# CRC16-IBM 查找表（反射多项式 0xA001）
+def make_crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = make_crc16_table()
+
+# 从给定的 CRC 中间状态继续累加 data，返回新的状态值
+def crc16_update(crc, data):
+    if crcmod_fast is not None:
+        return crcmod_fast(data, crc)
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+# CRC16-IBM 计算函数
+def crc16_ibm(data):
+    return crc16_update(0xFFFF, data).to_bytes(2, byteorder='big')
+
+# 序列号指令的固定帧头只构造一次，并预先算好帧头部分的 CRC 状态
+SERIAL_NUMBER_LENGTH = 14
+SERIAL_NUMBER_HEADER = bytes.fromhex('11 EF 04 1B 00 00 00 0F D2')
+SERIAL_NUMBER_HEADER_CRC = crc16_update(0xFFFF, SERIAL_NUMBER_HEADER)
+SERIAL_NUMBER_FRAME_SIZE = len(SERIAL_NUMBER_HEADER) + SERIAL_NUMBER_LENGTH + 2
+SERIAL_NUMBER_CHARACTERS = string.ascii_letters + string.digits
+
+# 用预编译帧头构造序列号指令，只计算可变部分的 CRC
+def build_serial_number_command(serial_number):
+    serial_bytes = serial_number.encode('ascii')
+    if len(serial_bytes) != SERIAL_NUMBER_LENGTH:
+        raise ValueError(f"序列号长度必须为 {SERIAL_NUMBER_LENGTH}: {serial_number}")
+    crc = crc16_update(SERIAL_NUMBER_HEADER_CRC, serial_bytes)
+    return SERIAL_NUMBER_HEADER + serial_bytes + crc.to_bytes(2, byteorder='big')
+
+# 生成 14 位序列号并构造指令；给定 allocator 时由其保证序列号不重复
+def generate_serial_number_command(allocator=None):
+    serial_number = allocator.allocate() if allocator is not None else random_serial_number()
+    log_debug(f"生成序列号: {serial_number}")
+    return build_serial_number_command(serial_number), serial_number
+
+# 批量生成 count 条序列号指令，写入一块连续缓冲区
+# 第 i 条指令为 buffer[i * SERIAL_NUMBER_FRAME_SIZE:(i + 1) * SERIAL_NUMBER_FRAME_SIZE]
+def generate_serial_number_commands(count, allocator=None):
+    buffer = bytearray(SERIAL_NUMBER_FRAME_SIZE * count)
+    serial_numbers = []
+    header_size = len(SERIAL_NUMBER_HEADER)
+    for i in range(count):
+        serial_number = allocator.allocate() if allocator is not None else random_serial_number()
+        serial_bytes = serial_number.encode('ascii')
+        offset = i * SERIAL_NUMBER_FRAME_SIZE
+        buffer[offset:offset + header_size] = SERIAL_NUMBER_HEADER
+        buffer[offset + header_size:offset + header_size + SERIAL_NUMBER_LENGTH] = serial_bytes
+        crc = crc16_update(SERIAL_NUMBER_HEADER_CRC, serial_bytes)
+        buffer[offset + SERIAL_NUMBER_FRAME_SIZE - 2:offset + SERIAL_NUMBER_FRAME_SIZE] = crc.to_bytes(2, byteorder='big')
+        serial_numbers.append(serial_number)
+    log_debug(f"批量生成序列号指令: {count} 条")
+    return buffer, serial_numbers
+
+# 批量缓冲区中第 index 条指令的只读视图（不复制）
+def serial_number_frame(buffer, index):
+    offset = index * SERIAL_NUMBER_FRAME_SIZE
+    return memoryview(buffer)[offset:offset + SERIAL_NUMBER_FRAME_SIZE]
+
+# 指令定义
+COMMANDS = {
+    "activate": [
+        bytes.fromhex('11 EF 04 1C 00 00 00 00 E0 00'),
+    ],
+    "low_freq_on": bytes.fromhex('11 EF 04 19 00 00 00 01 E2 01 FF'),
+    "low_freq_off": bytes.fromhex('11 EF 04 19 00 00 00 01 E2 00 00'),
+    "high_freq_on": bytes.fromhex('11 EF 04 18 00 00 00 01 E3 01 FF'),
+    "high_freq_off": bytes.fromhex('11 EF 04 18 00 00 00 01 E3 00 00'),
+    "light_on": bytes.fromhex('11 EF 04 1A 00 00 00 01 E1 01 FF'),
+    "light_off": bytes.fromhex('11 EF 04 1A 00 00 00 01 E1 00 00'),
+    "get_status": [
+        bytes.fromhex('11 EF 03 F5 00 00 00 00 08 00'),
+        bytes.fromhex('11 EF 04 0A 00 00 00 00 F2 00')
+    ],
+    "get_firmware_version": bytes.fromhex('11 EF 03 FB 00 00 00 00 02 00')
+}
+
+# 帧格式: SYNC(2) + CMD(2) + STATUS(2) + LEN(2) + LRC(1)，之后为 LEN 字节数据和 1 字节校验
+FRAME_SYNC = b'\x11\xEF'
+FRAME_HEADER_SIZE = 9
+
+# 单条命令等待完整响应帧的默认截止时间（秒），调用时未指定 timeout 即使用该值
+COMMAND_TIMEOUT = 1.0
+
+# 同时刷写的设备数上限，设为 1 即逐台顺序刷写
+MAX_CONCURRENT_DEVICES = 8
+
+# asyncio 后端同时在途的命令数上限
+ASYNC_MAX_INFLIGHT = 64
+
+# 多进程分片的进程数，以及子进程攒批发送调试日志的间隔（秒）
+SHARD_PROCESSES = os.cpu_count() or 1
+SHARD_LOG_FLUSH_INTERVAL = 0.1
+
+# 子进程以 spawn 方式启动会重新导入本模块，这些运行时可能被修改的配置由主进程传给子进程
+SHARD_SHARED_SETTINGS = ("COMMAND_TIMEOUT", "COMMAND_POLICIES", "CHAMELEON_USB_IDS", "EXTRA_PORTS",
+                         "CONNECTION_POOL_ENABLED")
+
+# 刷写记录账本的数据库路径，以及后台批量写入的批大小和最长等待时间（秒）
+LEDGER_PATH = "flash_ledger.db"
+LEDGER_BATCH_SIZE = 200
+LEDGER_FLUSH_INTERVAL = 0.5
+
+# 序列号库路径、分配策略（"random" 或 "sequential"）、顺序策略的前缀，
+# 每次预留的序列号块大小，以及布隆过滤器的设计容量
+SERIAL_DB_PATH = "serial_numbers.db"
+SERIAL_STRATEGY = "random"
+SERIAL_PREFIX = "CU"
+SERIAL_BLOCK_SIZE = 256
+SERIAL_BLOOM_CAPACITY = 2000000
+
+# 流水线窗口：一次连续写入的互相独立命令数上限，设为 1 即严格逐条收发
+PIPELINE_WINDOW = 1
+
+# 命令重试策略，按命令类型（见 COMMAND_NAMES）配置，未列出的字段取 "default"
+# timeout: 单次等待响应的超时（秒），None 为 COMMAND_TIMEOUT；retries: 失败后最多重发次数；
+# backoff / max_backoff: 第 n 次重发前等待 backoff * 2^(n-1) 秒，不超过 max_backoff；
+# kind: "idempotent" 直接重发，"verify" 先回读确认写入未生效再重发，"never" 不重发
+COMMAND_POLICIES = {
+    "default": {"timeout": None, "retries": 2, "backoff": 0.02, "max_backoff": 0.25, "kind": "idempotent"},
+    "activate": {"kind": "verify"},
+    "set_serial_number": {"kind": "verify"},
+}
+
+# 回读命令（get_status 第二条，设备信息），响应见 decode_device_info
+READBACK_COMMAND = COMMANDS["get_status"][1]
+
+# 差异模式读取设备当前状态的命令（get_status 两条），响应见 decode_device_settings / decode_device_info
+DEVICE_STATE_COMMANDS = COMMANDS["get_status"]
+
+# ChameleonUltra 的 USB VID/PID，不匹配的串口不做探测；设为空集合则探测所有串口
+CHAMELEON_USB_IDS = {(0x6868, 0x8686)}
+
+# 不在系统串口列表中、但也要检测的额外串口（如 chameleon_sim.py 创建的 pty），不做 VID/PID 过滤
+EXTRA_PORTS = []
+
+# 探测结果缓存有效期（秒），非 ChameleonUltra 的结果缓存时间较短
+PROBE_CACHE_TTL = 600
+PROBE_CACHE_NEGATIVE_TTL = 30
+
+# 连接池：检测通过的串口保持打开供刷写复用；验证超过 POOL_HEALTH_CHECK_AGE 秒的连接取用前先做健康检查，
+# 空闲超过 POOL_IDLE_TIMEOUT 秒的连接关闭
+CONNECTION_POOL_ENABLED = True
+POOL_HEALTH_CHECK_AGE = 5.0
+POOL_IDLE_TIMEOUT = 300
+
+# 刷写配置文件所在目录：--profile 给出的名称在此目录下查找 <名称>.json / .yaml / .yml
+FLASH_PROFILE_DIR = "profiles"
+
+# 刷写配置中的开关类步骤: 名称 -> (显示名, 日志中的命令名)
+FLASH_PROFILE_TOGGLES = {
+    "low_freq": ("低频ID循环", "低频ID命令"),
+    "high_freq": ("高频IC循环", "高频IC命令"),
+    "light": ("按亮循环", "按亮命令"),
+}
+
+# 刷写配置中 "frame" 步骤的默认提示文本，可在步骤中用 task / label / success / failure 覆盖；
+# 文本中的 {port} / {response} / {fields}（解码后的响应字段）在执行时替换
+FLASH_FRAME_STEP_TEXT = {
+    "task": None,
+    "label": "发送自定义命令",
+    "success": "{port} 自定义命令执行成功",
+    "failure": "{port} 自定义命令执行失败: {response}",
+}
+
+# 构造请求帧: SYNC + CMD + STATUS(0) + LEN + LRC + DATA + LRC
+def encode_frame(cmd, data=b''):
+    header = bytes(cmd) + b'\x00\x00' + len(data).to_bytes(2, 'big')
+    return FRAME_SYNC + header + bytes([(0x100 - sum(header)) & 0xFF]) + bytes(data) + bytes([(0x100 - sum(data)) & 0xFF])
+
+# 界面开关和命令行参数对应的刷写配置
+def settings_profile(settings):
+    steps = []
+    if settings["firmware"]:
+        steps += [{"step": "activate"}, {"step": "serial_number"}]
+    for key in FLASH_PROFILE_TOGGLES:
+        if settings.get(key) is not None:
+            steps.append({"step": key, "enabled": bool(settings[key])})
+    steps.append({"step": "get_status"})
+    return {"name": "settings", "steps": steps}
+
+# 读取刷写配置：path_or_name 为文件路径，或 FLASH_PROFILE_DIR 中的配置名；YAML 需要安装 PyYAML
+def load_flash_profile(path_or_name):
+    path = path_or_name
+    if not os.path.exists(path):
+        for suffix in (".json", ".yaml", ".yml"):
+            candidate = os.path.join(FLASH_PROFILE_DIR, path_or_name + suffix)
+            if os.path.exists(candidate):
+                path = candidate
+                break
+        else:
+            raise ValueError(f"找不到刷写配置: {path_or_name}")
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("读取 YAML 刷写配置需要安装 PyYAML")
+            profile = yaml.safe_load(f)
+        else:
+            profile = json.load(f)
+    if isinstance(profile, dict):
+        profile.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return profile
+
+# FLASH_PROFILE_DIR 中的全部配置名
+def list_flash_profiles():
+    if not os.path.isdir(FLASH_PROFILE_DIR):
+        return []
+    return sorted({os.path.splitext(name)[0] for name in os.listdir(FLASH_PROFILE_DIR)
+                   if name.endswith((".json", ".yaml", ".yml"))})
+
+# 校验并展开一个配置步骤，返回命令步骤列表；serial_number 步骤的命令在每台设备刷写时填入
+def compile_profile_step(name, index, spec):
+    where = f"刷写配置 {name} 第 {index + 1} 步"
+    if not isinstance(spec, dict) or not isinstance(spec.get("step"), str):
+        raise ValueError(f"{where}: 需要 step 字段")
+    kind = spec["step"]
+    timeout = spec.get("timeout")
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+        raise ValueError(f"{where}: timeout 必须是正数")
+
+    # state 为步骤要达到的设备状态 (字段, 值)，差异模式下设备已是该状态时跳过；readback 为状态查询步骤
+    def step(command, task, label, success, failure, ordered, state=None, readback=False):
+        return {"task": task, "command": command, "reply": command_code(command) if command else None,
+                "label": label, "success": success, "failure": failure, "ordered": ordered,
+                "state": state, "readback": readback,
+                "timeout": timeout if timeout is not None else
+                           command_policy(command)["timeout"] if command else named_policy("set_serial_number")["timeout"],
+                "serial_number": command is None}
+
+    if kind == "activate":
+        return [step(command, "当前执行项目: 激活 {port} 设备" if i == 0 else None, "发送固定激活命令",
+                     "{port} 固定激活命令执行成功", "{port} 固定激活命令执行失败: {response}", True,
+                     ("activated", True))
+                for i, command in enumerate(COMMANDS["activate"])]
+    if kind == "serial_number":
+        return [step(None, None, "发送序列号命令", "{port} 序列号命令执行成功",
+                     "{port} 序列号命令执行失败: {response}", True)]
+    if kind in FLASH_PROFILE_TOGGLES:
+        if not isinstance(spec.get("enabled"), bool):
+            raise ValueError(f"{where}: {kind} 需要布尔值 enabled")
+        display, label = FLASH_PROFILE_TOGGLES[kind]
+        state = "开启" if spec["enabled"] else "关闭"
+        return [step(COMMANDS[f"{kind}_on" if spec["enabled"] else f"{kind}_off"], f"当前执行项目: 设置 {{port}} {display}",
+                     f"发送{label}", f"{{port}} {display} {state}成功", f"{{port}} {display}设置失败: {{response}}", False,
+                     (kind, spec["enabled"]))]
+    if kind == "get_status":
+        return [step(command, "当前执行项目: 获取 {port} 状态" if i == 0 else None, "发送状态命令",
+                     "{port} 状态获取成功: {fields}", "{port} 状态获取失败: {response}", False,
+                     readback=True)
+                for i, command in enumerate(COMMANDS["get_status"])]
+    if kind == "frame":
+        try:
+            cmd = bytes.fromhex(spec["command"])
+            data = bytes.fromhex(spec.get("data", ""))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"{where}: frame 需要十六进制的 command（2 字节）和可选的 data")
+        if len(cmd) != 2:
+            raise ValueError(f"{where}: frame 的 command 必须为 2 字节")
+        # 帧头的 LEN 字段只有 2 字节
+        if len(data) > 0xFFFF:
+            raise ValueError(f"{where}: frame 的 data 最多 65535 字节，实际 {len(data)} 字节")
+        texts = {key: spec.get(key, default) for key, default in FLASH_FRAME_STEP_TEXT.items()}
+        for key, text in texts.items():
+            try:
+                if text is not None:
+                    text.format(port="", response="", fields="")
+            except (AttributeError, KeyError, IndexError, ValueError):
+                raise ValueError(f"{where}: {key} 只能使用 {{port}}、{{response}} 和 {{fields}} 占位符")
+        return [step(encode_frame(cmd, data), texts["task"], texts["label"], texts["success"], texts["failure"],
+                     bool(spec.get("ordered", False)))]
+    raise ValueError(f"{where}: 未知步骤类型 {kind}")
+
+# 编译后的刷写计划：步骤和批次在编译时确定，之后只读，可在任意多台设备、线程之间共用。
+# profile 为原始配置，分片子进程据此重新编译
+class FlashPlan(namedtuple("FlashPlan", "name profile steps batches needs_serial_number")):
+    __slots__ = ()
+
+    @property
+    def task_count(self):
+        return len(self.steps)
+
+    # 差异模式下已满足、不必发送的步骤序号：设备已是目标状态的步骤；
+    # 没有任何需要发送的写入步骤时，状态查询步骤也由刚读到的状态满足。
+    # 要写序列号时激活命令总是发送：序列号写入依赖激活，不凭读到的激活标志跳过
+    def satisfied_steps(self, state):
+        satisfied = {step["index"] for step in self.steps
+                     if step["state"] is not None and state.get(step["state"][0]) == step["state"][1]
+                     and not (self.needs_serial_number and step["state"][0] == "activated")}
+        if all(step["index"] in satisfied or step["readback"] for step in self.steps):
+            satisfied.update(step["index"] for step in self.steps if step["readback"])
+        return frozenset(satisfied)
+
+    # 单台设备的批次：只有序列号步骤需要按设备填入命令，其余批次原样复用；skip 中的步骤不发送
+    def device_batches(self, sn_cmd=None, skip=frozenset()):
+        for batch in self.batches:
+            if skip:
+                batch = tuple(step for step in batch if step["index"] not in skip)
+                if not batch:
+                    continue
+            if batch[0]["serial_number"]:
+                yield ({**batch[0], "command": sn_cmd, "reply": command_code(sn_cmd), "serial_number": False},)
+            else:
+                yield batch
+
+# 校验并编译刷写配置，配置错误抛出 ValueError
+def compile_flash_plan(profile, pipeline_window=PIPELINE_WINDOW):
+    if not isinstance(profile, dict) or not isinstance(profile.get("steps"), list) or not profile["steps"]:
+        raise ValueError("刷写配置需要非空的 steps 列表")
+    name = str(profile.get("name", "unnamed"))
+    steps = []
+    for index, spec in enumerate(profile["steps"]):
+        steps += compile_profile_step(name, index, spec)
+    steps = tuple(types.MappingProxyType({**step, "index": index}) for index, step in enumerate(steps))
+    batches = tuple(tuple(batch) for batch in batch_command_steps(steps, pipeline_window))
+    plan = FlashPlan(name, profile, steps, batches, any(step["serial_number"] for step in steps))
+    log_debug(f"刷写配置 {name} 已编译: {len(steps)} 条命令, {len(batches)} 批")
+    return plan
+
+# 把步骤分成批次：ordered 步骤（如激活、写序列号）单独成批并保持先后顺序，
+# 其余连续步骤最多 window 条一批流水线发送，同一批内命令号不重复以便按命令号匹配响应
+def batch_command_steps(steps, window=PIPELINE_WINDOW):
+    batches = []
+    current = []
+    for step in steps:
+        if step["ordered"] or window <= 1:
+            if current:
+                batches.append(current)
+                current = []
+            batches.append([step])
+            continue
+        if len(current) >= window or any(s["reply"] == step["reply"] for s in current):
+            batches.append(current)
+            current = []
+        current.append(step)
+    if current:
+        batches.append(current)
+    return batches
+
+# 帧中的命令号（字节 2-3），响应帧与请求帧的命令号相同
+def command_id(frame):
+    return bytes(frame[2:4])
+
+# 帧中的命令号（整数）
+def command_code(frame):
+    return (frame[2] << 8) | frame[3]
+
+# 帧头: SYNC, CMD, STATUS, LEN, 帧头 LRC（对 CMD 到 LEN 六个字节）
+FRAME_HEADER = struct.Struct(">2sHHHB")
+
+# 表示成功的响应状态码
+RESPONSE_OK_STATUSES = (0x0068, 0x0000)
+
+# 各命令号的响应数据结构
+FIRMWARE_VERSION_CMD = command_code(COMMANDS["get_firmware_version"])
+DEVICE_SETTINGS_CMD = command_code(COMMANDS["get_status"][0])
+DEVICE_INFO_CMD = command_code(COMMANDS["get_status"][1])
+FIRMWARE_VERSION_STRUCT = struct.Struct(">BB")
+DEVICE_SETTINGS_STRUCT = struct.Struct(">???")
+DEVICE_INFO_STRUCT = struct.Struct(f">?B{SERIAL_NUMBER_LENGTH}s")
+
+# 响应帧格式或校验错误
+class FrameError(ValueError):
+    pass
+
+# 解码后的响应帧：cmd / status 为整数，data 为 raw 上的 memoryview（不复制）。
+# str() 为原始帧的十六进制，用于日志和提示文本
+class Response(namedtuple("Response", "cmd status data raw")):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.status in RESPONSE_OK_STATUSES
+
+    def __str__(self):
+        return self.raw.hex()
+
+FirmwareVersion = namedtuple("FirmwareVersion", "major minor")
+DeviceSettings = namedtuple("DeviceSettings", "low_freq high_freq light")
+DeviceInfo = namedtuple("DeviceInfo", "activated battery serial_number")
+
+# 校验并解码一帧响应：SYNC、帧头 LRC、长度和数据 LRC，出错抛出 FrameError
+def decode_response(raw):
+    if len(raw) < FRAME_HEADER_SIZE + 1:
+        raise FrameError(f"响应数据过短: {len(raw)} 字节")
+    sync, cmd, status, length, header_lrc = FRAME_HEADER.unpack_from(raw)
+    if sync != FRAME_SYNC:
+        raise FrameError(f"无效 SYNC: {sync.hex()}")
+    view = memoryview(raw)
+    if (sum(view[2:8]) + header_lrc) & 0xFF:
+        raise FrameError("帧头校验错误")
+    if len(raw) != FRAME_HEADER_SIZE + length + 1:
+        raise FrameError(f"长度不符: 声明 {length} 字节数据，实际帧长 {len(raw)}")
+    data = view[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + length]
+    if (sum(data) + raw[-1]) & 0xFF:
+        raise FrameError("数据校验错误")
+    return Response(cmd, status, data, raw)
+
+# 把一帧完整响应转为 send_command 的返回值 (success, Response)；校验失败视为命令失败，按重试策略处理
+def decode_result(port, raw):
+    try:
+        return True, decode_response(raw)
+    except FrameError as e:
+        log_debug(f"{port} 响应校验失败: {str(e)}")
+        return False, f"响应校验失败: {str(e)}"
+
+# 按 layout 解码响应数据，只接受长度完全一致的数据，否则抛出 FrameError；
+# 差异模式据此对未知布局的响应退回完整刷写，而不是把其中的前几个字节当作设备状态
+def unpack_response(layout, response):
+    if len(response.data) != layout.size:
+        raise FrameError(f"响应数据长度不符: 需要 {layout.size} 字节，实际 {len(response.data)} 字节")
+    return layout.unpack(response.data)
+
+def decode_firmware_version(response):
+    return FirmwareVersion._make(unpack_response(FIRMWARE_VERSION_STRUCT, response))
+
+def decode_device_settings(response):
+    return DeviceSettings._make(unpack_response(DEVICE_SETTINGS_STRUCT, response))
+
+def decode_device_info(response):
+    activated, battery, serial_number = unpack_response(DEVICE_INFO_STRUCT, response)
+    return DeviceInfo(activated, battery, serial_number.decode('ascii', 'replace'))
+
+RESPONSE_DECODERS = {
+    FIRMWARE_VERSION_CMD: decode_firmware_version,
+    DEVICE_SETTINGS_CMD: decode_device_settings,
+    DEVICE_INFO_CMD: decode_device_info,
+}
+
+# 按命令号解码响应数据为对应的记录，没有对应结构或数据不完整时返回 None
+def decode_fields(response):
+    decoder = RESPONSE_DECODERS.get(response.cmd)
+    if decoder is None:
+        return None
+    try:
+        return decoder(response)
+    except FrameError:
+        return None
+
+# 响应字段的可读文本，用于提示信息中的 {fields}；没有对应结构时为原始帧的十六进制
+def describe_response(response):
+    fields = decode_fields(response) if isinstance(response, Response) else None
+    if fields is None:
+        return str(response)
+    if isinstance(fields, FirmwareVersion):
+        return f"固件版本 v{fields.major}.{fields.minor}"
+    if isinstance(fields, DeviceSettings):
+        state = lambda enabled: "开" if enabled else "关"
+        return f"低频ID循环 {state(fields.low_freq)}, 高频IC循环 {state(fields.high_freq)}, 按亮循环 {state(fields.light)}"
+    return f"{'已激活' if fields.activated else '未激活'}, 电量 {fields.battery}%, 序列号 {fields.serial_number}"
+
+# 校验 GET_FIRMWARE_VERSION 响应是否来自 ChameleonUltra
+def validate_firmware_response(port, response):
+    try:
+        response = decode_response(response)
+    except FrameError as e:
+        log_debug(f"{port} {str(e)}")
+        return False, str(e)
+    if response.cmd != FIRMWARE_VERSION_CMD:
+        log_debug(f"{port} 无效 CMD: {response.cmd:04x}")
+        return False, "无效 CMD"
+    if not response.ok:
+        log_debug(f"{port} 无效 STATUS: {response.status:04x}")
+        return False, "无效 STATUS"
+    log_debug(f"{port} 检测到 ChameleonUltra")
+    return True, "检测到 ChameleonUltra"
+
+# 固件版本响应中的版本号文本，如 "v2.0"；无法解码时返回空字符串
+def firmware_version_text(response):
+    try:
+        version = decode_firmware_version(decode_response(response))
+    except FrameError:
+        return ""
+    return f"v{version.major}.{version.minor}"
+
+# 命令延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 固定桶直方图，桶计数不累积，导出时再累加
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    # 按桶上界估算分位数，落在最后一个桶之外时返回最大值
+    def quantile(self, fraction):
+        target = fraction * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return None
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 6),
+        }
+
+# 命令号到命令类型名称的映射，用作指标的 command 标签；开关命令的 on/off 共用同一命令号
+def build_command_names():
+    names = {SERIAL_NUMBER_HEADER[2:4]: "set_serial_number"}
+    for name, commands in COMMANDS.items():
+        commands = commands if isinstance(commands, list) else [commands]
+        name = name.removesuffix("_on").removesuffix("_off")
+        for index, command in enumerate(commands):
+            names[command_id(command)] = name if len(commands) == 1 else f"{name}_{index + 1}"
+    return names
+
+COMMAND_NAMES = build_command_names()
+
+def command_name(command):
+    cmd = command_id(command)
+    return COMMAND_NAMES.get(cmd) or cmd.hex()
+
+# 原始响应帧的状态是否为成功（用于指标，不做完整解码）
+def response_ok(response):
+    return ((response[4] << 8) | response[5]) in RESPONSE_OK_STATUSES
+
+# 命令类型对应的重试策略
+def command_policy(command):
+    return named_policy(command_name(command))
+
+# 按命令类型名（见 COMMAND_NAMES）取重试策略
+def named_policy(name):
+    policy = dict(COMMAND_POLICIES["default"])
+    policy.update(COMMAND_POLICIES.get(name, {}))
+    return policy
+
+# 第 attempt 次重发前的退避时间（秒）
+def retry_delay(policy, attempt):
+    return min(policy["max_backoff"], policy["backoff"] * 2 ** (attempt - 1))
+
+# 命令是否需要重试：未收到响应、响应命令号与请求不符（残留的其他命令响应），或响应状态不是成功
+def command_failed(command, success, response):
+    return not success or response.cmd != command_code(command) or not response.ok
+
+# 由 DEVICE_STATE_COMMANDS 的两条响应得到设备当前状态（各开关、激活标志、电量和序列号），
+# 数据布局与预期不符时抛出 FrameError
+def parse_device_state(settings_response, info_response):
+    return {**decode_device_settings(settings_response)._asdict(), **decode_device_info(info_response)._asdict()}
+
+# 回读的设备信息是否表明 command 已经生效
+def readback_confirms(command, response):
+    name = command_name(command)
+    if name not in ("activate", "set_serial_number"):
+        return False
+    try:
+        info = decode_device_info(response)
+    except FrameError:
+        return False
+    if name == "activate":
+        return info.activated
+    serial_number = bytes(command[len(SERIAL_NUMBER_HEADER):len(SERIAL_NUMBER_HEADER) + SERIAL_NUMBER_LENGTH])
+    return info.serial_number == serial_number.decode('ascii', 'replace')
+
+# 按重试策略发送一条命令的过程，同步和异步引擎共用同一套逻辑，分别驱动：
+# 产出 ("send", command, timeout) 或 ("sleep", seconds)，send 的 (success, response) 通过 send() 传回；
+# result 为已经发送过一次的结果（如流水线批次），timeout 覆盖策略中的超时，结束时返回 (success, response, attempts, confirmed)；
+# 重试用尽或回读失败时最后一次响应仍未成功，success 为 False；confirmed 为 True 表示由回读确认生效，response 是回读帧
+def policy_steps(port, command, result=None, timeout=None):
+    policy = command_policy(command)
+    if timeout is not None:
+        policy["timeout"] = timeout
+    if result is None:
+        result = yield ("send", command, policy["timeout"])
+    attempts = 1
+    while command_failed(command, *result) and attempts <= policy["retries"] and policy["kind"] != "never":
+        yield ("sleep", retry_delay(policy, attempts))
+        if policy["kind"] == "verify":
+            # 写入命令可能已经生效只是响应丢失，回读确认后才决定是否重发
+            success, readback = yield ("send", READBACK_COMMAND, policy["timeout"])
+            if command_failed(READBACK_COMMAND, success, readback):
+                log_debug(f"{port} 回读失败，不重发 {command_name(command)}: {readback}")
+                break
+            if readback_confirms(command, readback):
+                log_debug(f"{port} 回读确认 {command_name(command)} 已生效")
+                return True, readback, attempts, True
+        log_debug(f"{port} 重发 {command_name(command)}（第 {attempts} 次重试），上次结果: {result[1]}")
+        result = yield ("send", command, policy["timeout"])
+        attempts += 1
+    return not command_failed(command, *result), result[1], attempts, False
+
+# 在线程中驱动 policy_steps
+def send_with_policy(device, command, result=None, timeout=None):
+    steps = policy_steps(device.port, command, result, timeout)
+    value = None
+    try:
+        while True:
+            action = steps.send(value)
+            if action[0] == "sleep":
+                time.sleep(action[1])
+                value = None
+            else:
+                value = device.send_command(action[1], action[2])
+    except StopIteration as stop:
+        return stop.value
+
+# 在事件循环中驱动 policy_steps
+async def async_send_with_policy(device, command, result=None, timeout=None):
+    steps = policy_steps(device.port, command, result, timeout)
+    value = None
+    try:
+        while True:
+            action = steps.send(value)
+            if action[0] == "sleep":
+                await asyncio.sleep(action[1])
+                value = None
+            else:
+                value = await device.send_command(action[1], action[2])
+    except StopIteration as stop:
+        return stop.value
+
+# 按命令类型和串口统计写入耗时、首字节时间、往返时间、收发字节数以及超时和失败次数
+class CommandMetrics:
+    FIELDS = ("write", "first_byte", "round_trip")
+    COUNTERS = ("requests", "timeouts", "failures", "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def new_series(self):
+        series = {field: Histogram() for field in self.FIELDS}
+        series.update({counter: 0 for counter in self.COUNTERS})
+        return series
+
+    # 记录一条命令；时间均为 time.perf_counter()，response 为空表示超时，为 None 表示发送出错
+    def record(self, port, command, started, written, first_byte, finished, response):
+        key = (command_name(command), port)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = self.new_series()
+            series["requests"] += 1
+            series["bytes_sent"] += len(command)
+            if written is not None:
+                series["write"].observe(written - started)
+            if response is None:
+                series["failures"] += 1
+                return
+            if first_byte is not None:
+                series["first_byte"].observe(first_byte - started)
+            if not response:
+                series["timeouts"] += 1
+                return
+            series["bytes_received"] += len(response)
+            series["round_trip"].observe(finished - started)
+            if not response_ok(response):
+                series["failures"] += 1
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    # 合并另一份统计（如分片子进程发回的 series）
+    def merge(self, series):
+        with self.lock:
+            for key, other in series.items():
+                mine = self.series.get(key)
+                if mine is None:
+                    mine = self.series[key] = self.new_series()
+                for field in self.FIELDS:
+                    mine[field].merge(other[field])
+                for counter in self.COUNTERS:
+                    mine[counter] += other[counter]
+
+    # 按 label（0 为命令类型，1 为串口）合并各序列
+    def aggregate(self, label):
+        groups = {}
+        for key, series in self.series.items():
+            group = groups.get(key[label])
+            if group is None:
+                group = groups[key[label]] = self.new_series()
+            for field in self.FIELDS:
+                group[field].merge(series[field])
+            for counter in self.COUNTERS:
+                group[counter] += series[counter]
+        return {
+            name: {**{counter: group[counter] for counter in self.COUNTERS},
+                   **{field: group[field].summary() for field in self.FIELDS}}
+            for name, group in sorted(groups.items())
+        }
+
+    # JSON 摘要：按命令类型和按串口两个维度
+    def summary(self):
+        with self.lock:
+            return {"commands": self.aggregate(0), "ports": self.aggregate(1)}
+
+    # Prometheus 文本格式
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            items = sorted(self.series.items())
+            for field in self.FIELDS:
+                metric = f"chameleon_command_{field}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for (name, port), series in items:
+                    histogram = series[field]
+                    labels = f'command="{prometheus_escape(name)}",port="{prometheus_escape(port)}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+            for counter in self.COUNTERS:
+                metric = f"chameleon_command_{counter}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (name, port), series in items:
+                    labels = f'command="{prometheus_escape(name)}",port="{prometheus_escape(port)}"'
+                    lines.append(f"{metric}{{{labels}}} {series[counter]}")
+        return "\n".join(lines) + "\n"
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+command_metrics = CommandMetrics()
+
+# 把本次运行的 JSON 摘要写入文件
+def save_metrics_summary(path, metrics=None):
+    summary = (metrics or command_metrics).summary()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+# 在本地 HTTP 端口导出指标：/metrics 为 Prometheus 文本，/metrics.json 为 JSON 摘要
+def start_metrics_server(port, host="127.0.0.1", metrics=None):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    metrics = metrics or command_metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.prometheus_text().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.summary(), ensure_ascii=False).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log_debug(f"指标服务已启动: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# 串口操作类
+class SerialDevice:
+    def __init__(self, port):
+        self.port = port
+        self.serial = None
+        self.is_connected = False
+        self.first_byte_at = None
+        self.firmware_response = None
+
+    def connect(self):
+        log_debug(f"尝试连接串口: {self.port}")
+        try:
+            self.serial = serial.Serial(self.port, baudrate=115200, timeout=1)
+            self.is_connected = True
+            log_debug(f"{self.port} 连接成功")
+            return True, "连接成功"
+        except serial.SerialException as e:
+            self.is_connected = False
+            log_debug(f"{self.port} 连接失败: {str(e)}")
+            return False, f"连接失败: {str(e)}"
+
+    def send_command(self, command, timeout=None):
+        if not self.is_connected:
+            log_debug(f"{self.port} 未连接，无法发送命令")
+            return False, "未连接"
+        started = time.perf_counter()
+        written = None
+        try:
+            if debug_handlers:
+                log_debug(f"{self.port} 发送命令: {command.hex()}")
+            self.serial.reset_input_buffer()
+            self.serial.write(command)
+            written = time.perf_counter()
+            response = self.read_frame(timeout)
+            command_metrics.record(self.port, command, started, written, self.first_byte_at,
+                                   time.perf_counter(), response)
+            if debug_handlers:
+                log_debug(f"{self.port} 接收响应: {response.hex()}")
+            if not response:
+                return False, "响应超时"
+            return decode_result(self.port, response)
+        except serial.SerialException as e:
+            command_metrics.record(self.port, command, started, written, None, None, None)
+            log_debug(f"{self.port} 命令发送失败: {str(e)}")
+            return False, f"命令发送失败: {str(e)}"
+
+    # 流水线发送：连续写入一组互相独立的命令，再按响应的命令号匹配回各自的请求，
+    # 返回与 commands 顺序一致的 (success, response) 列表
+    def send_pipelined(self, commands, timeout=None):
+        if not self.is_connected:
+            log_debug(f"{self.port} 未连接，无法发送命令")
+            return [(False, "未连接")] * len(commands)
+        timeout = COMMAND_TIMEOUT if timeout is None else timeout
+        results = [(False, "响应超时")] * len(commands)
+        pending = {command_id(command): index for index, command in enumerate(commands)}
+        started = time.perf_counter()
+        written = None
+        try:
+            if debug_handlers:
+                log_debug(f"{self.port} 流水线发送命令: {[command.hex() for command in commands]}")
+            self.serial.reset_input_buffer()
+            self.serial.write(b''.join(commands))
+            written = time.perf_counter()
+            deadline = time.monotonic() + timeout * len(commands)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                response = self.read_frame(remaining)
+                if not response:
+                    break
+                index = pending.pop(command_id(response), None)
+                if index is None:
+                    log_debug(f"{self.port} 丢弃无法匹配的响应: {response.hex()}")
+                    continue
+                command_metrics.record(self.port, commands[index], started, written, self.first_byte_at,
+                                       time.perf_counter(), response)
+                if debug_handlers:
+                    log_debug(f"{self.port} 接收响应: {response.hex()}")
+                results[index] = decode_result(self.port, response)
+            for index in pending.values():
+                command_metrics.record(self.port, commands[index], started, written, None, None, b'')
+        except serial.SerialException as e:
+            log_debug(f"{self.port} 命令发送失败: {str(e)}")
+            for index in pending.values():
+                command_metrics.record(self.port, commands[index], started, written, None, None, None)
+                results[index] = (False, f"命令发送失败: {str(e)}")
+        return results
+
+    # 在截止时间前读取恰好 size 字节，超时则返回已读到的部分
+    def read_exact(self, size, deadline):
+        data = bytearray()
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.serial.timeout = remaining
+            chunk = self.serial.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    # 按帧头声明的长度读取一帧响应，帧完整即返回；超时或帧不完整返回空字节
+    # 收到第一个字节的时刻记在 first_byte_at，供延迟指标使用。
+    # 每次设置 serial.timeout 都会重新配置串口，所以帧头整段读取，不逐字节查找 SYNC
+    def read_frame(self, timeout=None):
+        deadline = time.monotonic() + (COMMAND_TIMEOUT if timeout is None else timeout)
+        self.first_byte_at = None
+        header = self.read_exact(1, deadline)
+        if not header:
+            return b''
+        self.first_byte_at = time.perf_counter()
+        while True:
+            # 丢弃 SYNC 之前的杂散字节，末尾可能是 SYNC 的前半部分，先保留
+            start = header.find(FRAME_SYNC)
+            header = header[start:] if start >= 0 else header[-(len(FRAME_SYNC) - 1):]
+            if len(header) == FRAME_HEADER_SIZE:
+                break
+            chunk = self.read_exact(FRAME_HEADER_SIZE - len(header), deadline)
+            if not chunk:
+                if start >= 0:
+                    log_debug(f"{self.port} 帧头不完整: {header.hex()}")
+                return b''
+            header += chunk
+        length = int.from_bytes(header[6:8], byteorder='big')
+        body = self.read_exact(length + 1, deadline)
+        if len(body) < length + 1:
+            log_debug(f"{self.port} 帧数据不完整: {(header + body).hex()}")
+            return b''
+        return header + body
+
+    def close(self):
+        if self.serial and self.is_connected:
+            log_debug(f"关闭串口: {self.port}")
+            self.serial.close()
+            self.is_connected = False
+
+# 探测结果缓存，按 USB 身份（串口名、VID、PID、USB 序列号、位置）区分设备
+class ProbeCache:
+    def __init__(self, ttl=PROBE_CACHE_TTL, negative_ttl=PROBE_CACHE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(info):
+        return (info.device, info.vid, info.pid, info.serial_number, info.location)
+
+    def get(self, info):
+        key = self.key(info)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            is_chameleon, message, stamp = entry
+            ttl = self.ttl if is_chameleon else self.negative_ttl
+            if time.monotonic() - stamp > ttl:
+                del self.entries[key]
+                return None
+            return is_chameleon, message
+
+    def put(self, info, is_chameleon, message):
+        with self.lock:
+            self.entries[self.key(info)] = (is_chameleon, message, time.monotonic())
+
+    # 串口消失时清除该串口的全部缓存
+    def invalidate(self, port):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == port]:
+                del self.entries[key]
+
+probe_cache = ProbeCache()
+
+# 是否需要探测该串口：未配置白名单时全部探测，否则只探测 VID/PID 匹配的 USB 串口
+def is_candidate_port(info):
+    if not CHAMELEON_USB_IDS:
+        return True
+    return info is not None and (info.vid, info.pid) in CHAMELEON_USB_IDS
+
+# 按 VID/PID 过滤并查缓存，返回串口信息、需要实际探测的串口和命中缓存的结果
+def plan_probes(ports):
+    import serial.tools.list_ports
+    infos = {info.device: info for info in serial.tools.list_ports.comports()}
+    to_probe = []
+    cached = []
+    for port in ports:
+        info = infos.get(port)
+        if port not in EXTRA_PORTS and not is_candidate_port(info):
+            log_debug(f"{port} VID/PID 不匹配，跳过探测")
+            continue
+        result = probe_cache.get(info) if info is not None else None
+        if result is None:
+            to_probe.append(port)
+        else:
+            log_debug(f"{port} 使用缓存检测结果: {result[0]}")
+            cached.append((port,) + result)
+    return infos, to_probe, cached
+
+# 当前系统中的全部串口名
+def list_port_names():
+    import serial.tools.list_ports
+    names = [port.device for port in serial.tools.list_ports.comports()]
+    return names + [port for port in EXTRA_PORTS if port not in names]
+
+# 发送 GET_FIRMWARE_VERSION 并校验响应，判断串口上是否为 ChameleonUltra
+def check_chameleon_ultra(device):
+    if not device.is_connected:
+        success, message = device.connect()
+        if not success:
+            return False, message
+    command = COMMANDS["get_firmware_version"]
+    started = time.perf_counter()
+    written = None
+    try:
+        device.serial.reset_input_buffer()
+        device.serial.write(command)
+        written = time.perf_counter()
+        if debug_handlers:
+            log_debug(f"{device.port} 发送 GET_FIRMWARE_VERSION 命令: {command.hex()}")
+        response = device.read_frame()
+        command_metrics.record(device.port, command, started, written, device.first_byte_at,
+                               time.perf_counter(), response)
+        if debug_handlers:
+            log_debug(f"{device.port} GET_FIRMWARE_VERSION 响应: {response.hex()}")
+        is_chameleon, message = validate_firmware_response(device.port, response)
+        if is_chameleon:
+            device.firmware_response = response
+        return is_chameleon, message
+    except Exception as e:
+        command_metrics.record(device.port, command, started, written, None, None, None)
+        log_debug(f"{device.port} 检测失败: {str(e)}")
+        return False, f"检测失败: {str(e)}"
+
+# 探测单个串口，返回 (port, is_chameleon, message)；确认是 ChameleonUltra 时连接留在连接池中
+def probe_port(port):
+    device = SerialDevice(port)
+    is_chameleon, message = check_chameleon_ultra(device)
+    keep_connection(device, is_chameleon)
+    return port, is_chameleon, message
+
+# 检测结束后的连接处理：启用连接池且确认是 ChameleonUltra 时放入连接池，否则关闭
+def keep_connection(device, is_chameleon):
+    if CONNECTION_POOL_ENABLED and is_chameleon:
+        connection_pool.put(device)
+    else:
+        device.close()
+
+# 已验证连接池：检测确认是 ChameleonUltra 的串口句柄保持打开，刷写时直接取用，
+# 避免 USB CDC 反复打开/关闭串口的开销（部分设备关闭串口会复位）。
+# 同一句柄同一时间只借给一个使用者；取用时句柄验证已久则先发一次 GET_FIRMWARE_VERSION 做健康检查
+class ConnectionPool:
+    def __init__(self, health_check_age=POOL_HEALTH_CHECK_AGE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.health_check_age = health_check_age
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.borrowed = set()
+        self.evicted = set()
+        self.lock = threading.Lock()
+
+    # 放入（或归还）已验证的连接；同一串口原有的空闲连接被替换并关闭，借出期间串口已被移除则直接关闭
+    def put(self, device):
+        if not device.is_connected:
+            self.discard(device)
+            return
+        with self.lock:
+            self.borrowed.discard(device)
+            if device in self.evicted:
+                self.evicted.discard(device)
+                stale = device
+            else:
+                entry = self.entries.get(device.port)
+                stale = entry[0] if entry is not None and entry[0] is not device else None
+                self.entries[device.port] = (device, time.monotonic())
+        if stale is not None:
+            stale.close()
+        self.evict_idle()
+
+    # 取出一个可用连接，没有或健康检查失败时返回 None
+    def acquire(self, port):
+        self.evict_idle()
+        with self.lock:
+            entry = self.entries.pop(port, None)
+            if entry is not None:
+                self.borrowed.add(entry[0])
+        if entry is None:
+            return None
+        device, verified_at = entry
+        healthy = device.is_connected and device.serial.is_open
+        if healthy and time.monotonic() - verified_at > self.health_check_age:
+            healthy, _ = check_chameleon_ultra(device)
+        if not healthy:
+            log_debug(f"{port} 连接池中的连接已失效，重新打开串口")
+            self.discard(device)
+            return None
+        log_debug(f"{port} 复用连接池中的连接")
+        return device
+
+    # 归还连接：healthy 为 False 时关闭，不再放回池中
+    def release(self, device, healthy=True):
+        if healthy:
+            self.put(device)
+        else:
+            self.discard(device)
+
+    # 池中该串口空闲连接的固件版本响应，没有空闲连接时返回 None
+    def firmware_response(self, port):
+        with self.lock:
+            entry = self.entries.get(port)
+        return entry[0].firmware_response if entry is not None else None
+
+    def discard(self, device):
+        with self.lock:
+            self.borrowed.discard(device)
+            self.evicted.discard(device)
+        device.close()
+
+    # 串口拔出：关闭空闲连接，借出中的连接在归还时关闭
+    def evict(self, port):
+        with self.lock:
+            entry = self.entries.pop(port, None)
+            self.evicted.update(device for device in self.borrowed if device.port == port)
+        if entry is not None:
+            log_debug(f"{port} 已移除，关闭连接池中的连接")
+            entry[0].close()
+
+    # 关闭空闲超时的连接；put 和 acquire 时执行，界面空闲时另由定时器调用
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [port for port, (_, verified_at) in self.entries.items() if now - verified_at > self.idle_timeout]
+            devices = [self.entries.pop(port)[0] for port in idle]
+        for device in devices:
+            log_debug(f"{device.port} 连接空闲超时，关闭")
+            device.close()
+
+    def close_all(self):
+        with self.lock:
+            devices = [device for device, _ in self.entries.values()]
+            self.entries.clear()
+        for device in devices:
+            device.close()
+
+connection_pool = ConnectionPool()
+
+# 并发探测串口（默认全部串口），结果写入探测缓存；on_result 每得到一个结果调用一次
+def detect_chameleon_ports(ports=None, max_workers=MAX_CONCURRENT_DEVICES, on_result=None):
+    ports = ports if ports is not None else list_port_names()
+    infos, ports, results = plan_probes(ports)
+    if on_result is not None:
+        for result in results:
+            on_result(*result)
+    if ports:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(ports)), thread_name_prefix="probe") as executor:
+            for future in as_completed([executor.submit(probe_port, port) for port in ports]):
+                port, is_chameleon, message = future.result()
+                log_debug(f"{port} 检测结果: {is_chameleon}, 信息: {message}")
+                if port in infos:
+                    probe_cache.put(infos[port], is_chameleon, message)
+                if on_result is not None:
+                    on_result(port, is_chameleon, message)
+                results.append((port, is_chameleon, message))
+    return results
+
+# 刷写记录账本：SQLite（WAL 模式）持久化每台设备的刷写结果。
+# 写入由后台线程整批提交，不阻塞刷写线程；按序列号和时间范围的查询走索引
+class FlashLedger:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS flashes (
+            id INTEGER PRIMARY KEY,
+            started_at REAL NOT NULL,
+            finished_at REAL NOT NULL,
+            port TEXT NOT NULL,
+            usb_serial TEXT,
+            serial_number TEXT,
+            firmware_version TEXT,
+            settings TEXT NOT NULL,
+            success INTEGER NOT NULL,
+            errors TEXT NOT NULL,
+            commands TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_flashes_serial_number ON flashes (serial_number);
+        CREATE INDEX IF NOT EXISTS idx_flashes_started_at ON flashes (started_at);
+    """
+    COLUMNS = ("started_at", "finished_at", "port", "usb_serial", "serial_number", "firmware_version",
+               "settings", "success", "errors", "commands")
+
+    def __init__(self, path=LEDGER_PATH, batch_size=LEDGER_BATCH_SIZE, flush_interval=LEDGER_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        connection = self.connect()
+        connection.executescript(self.SCHEMA)
+        # 旧版本创建的数据库没有 firmware_version 列
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(flashes)")}
+        if "firmware_version" not in columns:
+            connection.execute("ALTER TABLE flashes ADD COLUMN firmware_version TEXT")
+        connection.close()
+        self.thread = threading.Thread(target=self.write_loop, name="ledger", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    # 记录一台设备的刷写结果，只入队，由后台线程写入
+    def add(self, record):
+        self.queue.put(record)
+
+    # 收到第一条记录后继续收集，直到攒满 batch_size 条或距第一条已过 flush_interval 秒再一次提交；
+    # 收到 None 时写完已收集的记录后退出
+    def write_loop(self):
+        connection = self.connect()
+        closing = False
+        while not closing:
+            record = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while record is not None:
+                batch.append(record)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            closing = record is None
+            if batch:
+                self.write_batch(connection, batch)
+        connection.close()
+
+    def write_batch(self, connection, batch):
+        rows = [(
+            record["started_at"], record["finished_at"], record["port"], record["usb_serial"],
+            record["serial_number"], record.get("firmware_version"), json.dumps(record["settings"]), int(record["success"]),
+            json.dumps(record["errors"], ensure_ascii=False), json.dumps(record["commands"], ensure_ascii=False, default=bytes.hex),
+        ) for record in batch]
+        try:
+            with connection:
+                connection.executemany(
+                    f"INSERT INTO flashes ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", rows)
+            log_debug(f"刷写记录已写入: {len(rows)} 条")
+        except sqlite3.Error as e:
+            log_debug(f"刷写记录写入失败: {str(e)}")
+
+    def query(self, where, params):
+        connection = self.connect()
+        try:
+            cursor = connection.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM flashes WHERE {where} ORDER BY started_at", params)
+            records = []
+            for row in cursor:
+                record = dict(zip(self.COLUMNS, row))
+                record["settings"] = json.loads(record["settings"])
+                record["success"] = bool(record["success"])
+                record["errors"] = json.loads(record["errors"])
+                record["commands"] = json.loads(record["commands"])
+                records.append(record)
+            return records
+        finally:
+            connection.close()
+
+    def find_by_serial_number(self, serial_number):
+        return self.query("serial_number = ?", (serial_number,))
+
+    # 按开始时间查询，start / end 为 Unix 时间戳，None 表示不限
+    def find_by_time(self, start=None, end=None):
+        return self.query("started_at BETWEEN ? AND ?",
+                          (start if start is not None else 0, end if end is not None else float("inf")))
+
+    # 写完队列中剩余的记录后停止后台线程
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+# 布隆过滤器：判断序列号是否可能已发放，命中时再到数据库精确确认
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode('ascii'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+# 随机序列号（密码学安全随机数）
+def random_serial_number():
+    return ''.join(secrets.choice(SERIAL_NUMBER_CHARACTERS) for _ in range(SERIAL_NUMBER_LENGTH))
+
+# 随机分配策略
+class RandomSerialStrategy:
+    name = "random"
+
+    def candidates(self, connection):
+        while True:
+            yield random_serial_number()
+
+    def save(self, connection):
+        pass
+
+# 顺序分配策略：前缀 + 36 进制计数，计数器持久化在数据库中
+class SequentialSerialStrategy:
+    name = "sequential"
+    DIGITS = string.digits + string.ascii_uppercase
+
+    def __init__(self, prefix=SERIAL_PREFIX):
+        if len(prefix) >= SERIAL_NUMBER_LENGTH or not prefix.isalnum():
+            raise ValueError(f"序列号前缀无效: {prefix}")
+        self.prefix = prefix
+        self.width = SERIAL_NUMBER_LENGTH - len(prefix)
+        self.counter = None
+
+    def key(self):
+        return f"sequential:{self.prefix}"
+
+    def format(self, value):
+        digits = []
+        for _ in range(self.width):
+            value, digit = divmod(value, len(self.DIGITS))
+            digits.append(self.DIGITS[digit])
+        if value:
+            raise RuntimeError(f"序列号前缀 {self.prefix} 的编号已用尽")
+        return self.prefix + ''.join(reversed(digits))
+
+    def candidates(self, connection):
+        row = connection.execute("SELECT value FROM allocator_state WHERE key = ?", (self.key(),)).fetchone()
+        self.counter = int(row[0]) if row else 0
+        while True:
+            value = self.counter
+            self.counter += 1
+            yield self.format(value)
+
+    def save(self, connection):
+        connection.execute("INSERT OR REPLACE INTO allocator_state (key, value) VALUES (?, ?)",
+                           (self.key(), str(self.counter)))
+
+# 序列号分配器：所有发放过的序列号持久化在 SQLite 中保证永不重复。
+# 后台线程按块预留序列号，allocate() 只从内存中取，不访问磁盘
+class SerialNumberAllocator:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS serial_numbers (
+            serial_number TEXT PRIMARY KEY,
+            strategy TEXT NOT NULL,
+            reserved_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS allocator_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=SERIAL_DB_PATH, strategy=None, block_size=SERIAL_BLOCK_SIZE,
+                 bloom_capacity=SERIAL_BLOOM_CAPACITY, bloom_error_rate=0.001):
+        self.path = path
+        self.strategy = strategy or RandomSerialStrategy()
+        self.block_size = max(1, block_size)
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self.connection = None
+        self.reserved = deque()
+        self.condition = threading.Condition()
+        self.refilling = False
+        self.error = None
+        with self.condition:
+            self.start_refill()
+
+    # 调用方需持有 self.condition
+    def start_refill(self):
+        if self.refilling:
+            return
+        self.refilling = True
+        threading.Thread(target=self.refill, name="serial-allocator", daemon=True).start()
+
+    def open(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(self.SCHEMA)
+        count = 0
+        for (serial_number,) in connection.execute("SELECT serial_number FROM serial_numbers"):
+            self.bloom.add(serial_number)
+            count += 1
+        log_debug(f"序列号库已加载: {count} 条")
+        self.connection = connection
+
+    def refill(self):
+        try:
+            if self.connection is None:
+                self.open()
+            block = self.reserve_block()
+            with self.condition:
+                self.reserved.extend(block)
+        except Exception as e:
+            log_debug(f"序列号预留失败: {str(e)}")
+            self.error = e
+        finally:
+            with self.condition:
+                self.refilling = False
+                self.condition.notify_all()
+
+    # 在一个 IMMEDIATE 事务中预留一块序列号：顺序计数器的读取和递增都在写锁内完成，
+    # 共用同一数据库的多个分配器不会拿到同一段编号。布隆过滤器命中时再精确查询；
+    # 其他分配器写入的序列号不在本进程的布隆过滤器中，插入冲突时跳过
+    def reserve_block(self):
+        block = []
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for candidate in self.strategy.candidates(self.connection):
+                if candidate in self.bloom and self.connection.execute(
+                        "SELECT 1 FROM serial_numbers WHERE serial_number = ?", (candidate,)).fetchone():
+                    continue
+                inserted = self.connection.execute(
+                    "INSERT OR IGNORE INTO serial_numbers (serial_number, strategy, reserved_at) VALUES (?, ?, ?)",
+                    (candidate, self.strategy.name, now)).rowcount
+                self.bloom.add(candidate)
+                if not inserted:
+                    continue
+                block.append(candidate)
+                if len(block) >= self.block_size:
+                    break
+            self.strategy.save(self.connection)
+        log_debug(f"预留序列号: {len(block)} 条")
+        return block
+
+    # 取一个未发放过的序列号；预留量低于半块时在后台补充
+    def allocate(self, timeout=10):
+        with self.condition:
+            if len(self.reserved) < self.block_size // 2:
+                self.start_refill()
+            while not self.reserved:
+                if self.error is not None:
+                    error, self.error = self.error, None
+                    raise RuntimeError(f"序列号分配失败: {str(error)}")
+                self.start_refill()
+                if not self.condition.wait(timeout):
+                    raise RuntimeError("序列号分配超时")
+            return self.reserved.popleft()
+
+    # 未用完的预留序列号不会再次发放
+    def close(self):
+        with self.condition:
+            while self.refilling:
+                self.condition.wait()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+# 按配置创建序列号分配器
+def make_serial_allocator(path=SERIAL_DB_PATH, strategy=SERIAL_STRATEGY, prefix=SERIAL_PREFIX):
+    if strategy == "sequential":
+        return SerialNumberAllocator(path, SequentialSerialStrategy(prefix))
+    return SerialNumberAllocator(path, RandomSerialStrategy())
+
+# 串口对应的 USB 序列号，非 USB 串口为 None
+def port_usb_serials(ports):
+    import serial.tools.list_ports
+    infos = {info.device: info for info in serial.tools.list_ports.comports()}
+    return {port: infos[port].serial_number if port in infos else None for port in ports}
+
+# 刷写事件聚合：工作线程中的 report 只更新内存中的状态，界面按固定帧率调用 snapshot
+# 取走一次合并后的快照。进度、当前任务和设备状态只保留最新值，结果逐条保留，最终结果不丢失
+class ProgressAggregator:
+    def __init__(self):
+        self.progress = None
+        self.task = None
+        self.results = []
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    # 与 FlashJob 的 report 回调签名相同；调试日志本身已批量刷新，直接转发
+    def report(self, kind, value):
+        if kind == "debug":
+            log_debug(value)
+            return
+        with self.lock:
+            if kind == "progress":
+                # 进度在锁外上报，可能乱序到达，只取最大值
+                self.progress = value if self.progress is None else max(self.progress, value)
+            elif kind == "task":
+                self.task = value
+            elif kind == "result":
+                self.results.append(value)
+            elif kind == "device":
+                port, status = value
+                self.devices[port] = status
+
+    # 取走上次快照之后的变化，没有变化的字段为 None 或空
+    def snapshot(self):
+        with self.lock:
+            snapshot = {"progress": self.progress, "task": self.task, "results": self.results,
+                        "devices": self.devices}
+            self.progress = None
+            self.task = None
+            self.results = []
+            self.devices = {}
+        return snapshot
+
+# 刷写任务公共部分：进度、错误汇总、步骤结果上报和刷写记录。
+# report(kind, value) 上报 progress / task / result / debug 四类事件
+# plan 为已编译的刷写计划（见 compile_flash_plan），为 None 时按 settings 编译
+class FlashJobBase:
+    def __init__(self, ports, settings, serial_numbers, report, pipeline_window=PIPELINE_WINDOW, ledger=None,
+                 plan=None):
+        self.ports = ports
+        self.settings = settings
+        self.serial_numbers = serial_numbers
+        self.report = report
+        self.pipeline_window = pipeline_window
+        self.ledger = ledger
+        self.plan = plan or compile_flash_plan(settings_profile(settings), pipeline_window)
+        # 差异模式：先读取设备当前状态，只发送会改变状态的命令
+        self.differential = bool(settings.get("differential"))
+        self.errors = []
+        self.device_errors = {port: [] for port in ports}
+        self.total_tasks = self.count_device_tasks() * len(ports)
+        self.completed_tasks = 0
+        self.usb_serials = {}
+        self.lock = threading.Lock()
+
+    # 单台设备需要执行的命令数
+    def count_device_tasks(self):
+        return self.plan.task_count
+
+    def device_batches(self, port, skip=frozenset()):
+        return self.plan.device_batches(self.serial_numbers[port][0] if self.plan.needs_serial_number else None, skip)
+
+    # 差异模式：results 为 DEVICE_STATE_COMMANDS 的 (success, response, attempts, confirmed)，返回不必发送的步骤序号。
+    # 已是目标状态的步骤记为跳过；状态查询步骤直接使用读到的响应；读取失败时完整刷写
+    def apply_device_state(self, port, record, results):
+        if any(command_failed(command, success, response)
+               for command, (success, response, _, _) in zip(DEVICE_STATE_COMMANDS, results)):
+            self.report("debug", f"{port} 读取设备状态失败，完整刷写: {[response for _, response, _, _ in results]}")
+            return frozenset()
+        responses = {response.cmd: response for _, response, _, _ in results}
+        try:
+            state = parse_device_state(*(response for _, response, _, _ in results))
+        except FrameError:
+            self.report("debug", f"{port} 设备状态数据布局未知，完整刷写: {[str(response) for _, response, _, _ in results]}")
+            return frozenset()
+        skip = self.plan.satisfied_steps(state)
+        self.report("debug", f"{port} 当前状态: {state}，跳过 {len(skip)}/{self.plan.task_count} 条命令")
+        for step in self.plan.steps:
+            if step["index"] not in skip:
+                continue
+            if step["readback"]:
+                self.finish_step(record, step, True, responses[step["reply"]], 0)
+            else:
+                self.skip_step(record, step)
+        return skip
+
+    # 设备已是目标状态，不发送该命令，计入进度
+    def skip_step(self, record, step):
+        port = record["port"]
+        self.report("result", f"{port} {step['label']}: 设备已是目标状态，跳过")
+        record["commands"].append({
+            "label": step["label"],
+            "command": step["command"],
+            "success": True,
+            "skipped": True,
+        })
+        self.task_done()
+
+    def add_error(self, port, message):
+        with self.lock:
+            self.device_errors[port].append(message)
+
+    def task_done(self):
+        with self.lock:
+            self.completed_tasks += 1
+            progress = int(self.completed_tasks / self.total_tasks * 100)
+        self.report("progress", progress)
+
+    def report_task(self, port, batch):
+        for step in batch:
+            if step["task"]:
+                self.report("task", step["task"].format(port=port))
+
+    # 连接失败时上报错误，跳过的命令也计入进度，保证进度条能走到 100%
+    def connect_failed(self, port, message):
+        self.add_error(port, f"{port} 连接失败: {message}")
+        self.report("result", f"{port} 连接失败: {message}")
+        self.report("debug", f"{port} 连接失败: {message}")
+        for _ in range(self.count_device_tasks()):
+            self.task_done()
+
+    # 刷写结束后的连接处理：没有错误的连接放回连接池，否则关闭
+    def release_device(self, port, device):
+        if CONNECTION_POOL_ENABLED:
+            connection_pool.release(device, healthy=not self.device_errors[port])
+        else:
+            device.close()
+
+    # confirmed 为 True 时 response 是确认命令已生效的回读帧，命令号与请求不同
+    def finish_step(self, record, step, success, response, elapsed, attempts=1, confirmed=False):
+        port = record["port"]
+        # 响应的命令号必须与请求一致
+        if not confirmed and isinstance(response, Response) and response.cmd != step["reply"]:
+            success = False
+            response = f"响应命令号不匹配: {response}"
+        if debug_handlers:
+            self.report("debug", f"{port} {step['label']}: {step['command'].hex()} 返回: {response}")
+        if success:
+            self.report("result", step["success"].format(port=port, response=response,
+                                                         fields=describe_response(response)))
+        else:
+            message = step["failure"].format(port=port, response=response, fields=describe_response(response))
+            self.add_error(port, message)
+            self.report("result", message)
+        # 记录中同时保留原始帧（十六进制）和解码后的字段
+        decoded = isinstance(response, Response)
+        fields = decode_fields(response) if decoded else None
+        record["commands"].append({
+            "label": step["label"],
+            "command": step["command"],
+            "success": success,
+            "response": response.raw if decoded else response,
+            "status": response.status if decoded else None,
+            "fields": fields._asdict() if fields is not None else None,
+            "elapsed_ms": round(elapsed * 1000, 2),
+            "attempts": attempts,
+            "confirmed": confirmed,
+        })
+        self.task_done()
+
+    def start_records(self):
+        if self.ledger is not None:
+            self.usb_serials = port_usb_serials(self.ports)
+
+    def new_record(self, port):
+        return {
+            "port": port,
+            "usb_serial": self.usb_serials.get(port),
+            "serial_number": self.serial_numbers[port][1] if self.plan.needs_serial_number else None,
+            "settings": self.settings,
+            "firmware_version": None,
+            "started_at": time.time(),
+            "commands": [],
+        }
+
+    # 设备处理结束：上报设备状态，并写入刷写记录
+    def finish_record(self, record):
+        errors = self.device_errors[record["port"]]
+        self.report("device", (record["port"], "failed" if errors else "done"))
+        if self.ledger is None:
+            return
+        record["finished_at"] = time.time()
+        record["errors"] = list(errors)
+        record["success"] = not errors
+        self.ledger.add(record)
+
+    # 按设备顺序汇总错误
+    def collect_errors(self):
+        for port in self.ports:
+            self.errors.extend(self.device_errors[port])
+        return self.errors
+
+# 同步刷写任务：每台设备在独立的工作线程中按顺序执行命令，设备之间并发，不依赖 Qt
+class FlashJob(FlashJobBase):
+    def __init__(self, ports, settings, serial_numbers, report, max_workers=MAX_CONCURRENT_DEVICES,
+                 pipeline_window=PIPELINE_WINDOW, ledger=None, plan=None):
+        super().__init__(ports, settings, serial_numbers, report, pipeline_window, ledger, plan)
+        self.max_workers = max(1, max_workers)
+
+    def run(self):
+        log_debug(f"FlashJob 启动，处理设备: {self.ports}, 配置: {self.settings}, 并发数: {self.max_workers}")
+        log_debug(f"总任务数: {self.total_tasks}")
+        self.start_records()
+
+        workers = min(self.max_workers, len(self.ports)) or 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flash") as executor:
+            futures = {executor.submit(self.process_port, port): port for port in self.ports}
+            for future in as_completed(futures):
+                port = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.add_error(port, f"{port} 处理异常: {str(e)}")
+                    log_debug(f"{port} 处理异常: {str(e)}")
+        return self.collect_errors()
+
+    def process_port(self, port):
+        log_debug(f"开始处理设备: {port}")
+        record = self.new_record(port)
+        self.report("device", (port, "flashing"))
+        device = connection_pool.acquire(port) if CONNECTION_POOL_ENABLED else None
+        try:
+            if device is None:
+                device = SerialDevice(port)
+                success, message = device.connect()
+                if not success:
+                    self.connect_failed(port, message)
+                    return
+                self.report("debug", f"{port} 连接成功")
+            else:
+                self.report("debug", f"{port} 复用已验证的连接")
+            if device.firmware_response:
+                record["firmware_version"] = firmware_version_text(device.firmware_response)
+
+            skip = frozenset()
+            if self.differential:
+                if self.pipeline_window > 1:
+                    results = [send_with_policy(device, command, result) for command, result in
+                               zip(DEVICE_STATE_COMMANDS, device.send_pipelined(DEVICE_STATE_COMMANDS))]
+                else:
+                    results = [send_with_policy(device, command) for command in DEVICE_STATE_COMMANDS]
+                skip = self.apply_device_state(port, record, results)
+
+            for batch in self.device_batches(port, skip):
+                self.report_task(port, batch)
+                started = time.perf_counter()
+                if len(batch) == 1:
+                    results = [send_with_policy(device, batch[0]["command"], None, batch[0]["timeout"])]
+                else:
+                    # 流水线中失败的命令逐条按策略重试
+                    results = [send_with_policy(device, step["command"], result, step["timeout"])
+                               for step, result in zip(batch, device.send_pipelined([step["command"] for step in batch]))]
+                elapsed = time.perf_counter() - started
+                for step, (success, response, attempts, confirmed) in zip(batch, results):
+                    self.finish_step(record, step, success, response, elapsed, attempts, confirmed)
+        finally:
+            if device is not None:
+                self.release_device(port, device)
+            self.finish_record(record)
+
+# 无人值守工位：检测到的设备随时入队，用固定配置在线程池中逐台刷写，不依赖 Qt。
+# 同一串口刷写结束后在拔出（forget）之前不会重复刷写；on_status(port, status, detail) 上报
+# 每台设备的状态变化，status 为 queued / flashing / done / failed
+class FlashStation:
+    def __init__(self, settings, report, on_status, allocator=None, ledger=None,
+                 max_workers=MAX_CONCURRENT_DEVICES, pipeline_window=PIPELINE_WINDOW):
+        self.settings = dict(settings)
+        # 配置固定不变，计划只编译一次，所有设备共用
+        self.plan = compile_flash_plan(settings_profile(self.settings), pipeline_window)
+        self.report = report
+        self.on_status = on_status
+        self.allocator = allocator
+        self.ledger = ledger
+        self.pipeline_window = pipeline_window
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="station")
+        self.states = {}
+        self.forgotten = set()
+        self.counts = {"done": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    # 设备入队；该串口已在队列中、正在刷写或已刷写过时返回 False
+    def submit(self, port):
+        with self.lock:
+            if port in self.states:
+                return False
+            self.states[port] = "queued"
+        self.on_status(port, "queued", "")
+        self.executor.submit(self.process, port)
+        return True
+
+    # 设备拔出：排队中的不再刷写，之后同一串口接入的新设备会重新入队
+    def forget(self, port):
+        with self.lock:
+            if self.states.get(port) == "flashing":
+                self.forgotten.add(port)
+            else:
+                self.states.pop(port, None)
+
+    def process(self, port):
+        with self.lock:
+            if port not in self.states:
+                log_debug(f"{port} 已移除，跳过刷写")
+                return
+            self.states[port] = "flashing"
+        self.on_status(port, "flashing", "")
+        try:
+            serial_numbers = {}
+            if self.plan.needs_serial_number:
+                serial_numbers[port] = generate_serial_number_command(self.allocator)
+            errors = FlashJob([port], self.settings, serial_numbers, self.report, 1,
+                              self.pipeline_window, self.ledger, self.plan).run()
+        except Exception as e:
+            errors = [f"{port} 处理异常: {str(e)}"]
+        status = "failed" if errors else "done"
+        with self.lock:
+            self.counts[status] += 1
+            if port in self.forgotten:
+                self.forgotten.discard(port)
+                self.states.pop(port, None)
+            else:
+                self.states[port] = status
+        detail = "; ".join(errors) if errors else (serial_numbers[port][1] if serial_numbers else "")
+        log_debug(f"{port} 无人值守刷写{'失败' if errors else '完成'}: {detail}")
+        self.on_status(port, status, detail)
+
+    # 停止接收新设备；wait 为 True 时等待在途刷写结束
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+# 分片子进程中代替刷写记录账本：记录经 IPC 送回主进程，由主进程的账本统一写入
+class ShardLedger:
+    def __init__(self, events, shard):
+        self.events = events
+        self.shard = shard
+
+    def add(self, record):
+        self.events.put(("record", self.shard, record))
+
+# 分片子进程入口：按主进程的刷写配置重新编译计划，对分到的串口运行 FlashJob，事件以 (kind, shard, value) 元组发回主进程。
+# 进度只发送 "task_done"，由主进程汇总成总进度；调试日志在子进程中攒批后整批发送
+def run_shard(shard, ports, settings, profile, serial_numbers, max_workers, pipeline_window, use_ledger,
+              forward_logs, shared_settings, events):
+    globals().update(shared_settings)
+    logs = DebugLogBuffer()
+    debug_handlers[:] = [logs.append] if forward_logs else []
+    stopped = threading.Event()
+
+    def flush_logs():
+        lines, dropped = logs.drain()
+        if dropped:
+            lines.append(f"分片 {shard} 丢弃了 {dropped} 条调试日志")
+        if lines:
+            events.put(("logs", shard, lines))
+
+    def flush_loop():
+        while not stopped.wait(SHARD_LOG_FLUSH_INTERVAL):
+            flush_logs()
+
+    def report(kind, value):
+        if kind == "progress":
+            events.put(("task_done", shard, None))
+        else:
+            events.put((kind, shard, value))
+
+    threading.Thread(target=flush_loop, name="shard-logs", daemon=True).start()
+    device_errors = {}
+    try:
+        ledger = ShardLedger(events, shard) if use_ledger else None
+        plan = compile_flash_plan(profile, pipeline_window)
+        job = FlashJob(ports, settings, serial_numbers, report, max_workers, pipeline_window, ledger, plan)
+        job.run()
+        device_errors = job.device_errors
+    except Exception as e:
+        device_errors = {port: [f"{port} 分片进程异常: {str(e)}"] for port in ports}
+    finally:
+        connection_pool.close_all()
+        stopped.set()
+        flush_logs()
+        events.put(("metrics", shard, command_metrics.series))
+        events.put(("done", shard, device_errors))
+
+# 分片检测子进程入口：每得到一个检测结果发回一个 ("detect", shard, (port, is_chameleon, message))
+def run_detect_shard(shard, ports, max_workers, shared_settings, events):
+    globals().update(shared_settings)
+    debug_handlers[:] = []
+    try:
+        detect_chameleon_ports(ports, max_workers, on_result=lambda *result: events.put(("detect", shard, result)))
+    finally:
+        connection_pool.close_all()
+        events.put(("metrics", shard, command_metrics.series))
+        events.put(("done", shard, None))
+
+# 多进程分片检测，返回值和 on_result 与 detect_chameleon_ports 相同。
+# 子进程中的连接无法交给主进程，检测结束后即关闭
+def detect_chameleon_ports_sharded(ports=None, processes=SHARD_PROCESSES, max_workers=MAX_CONCURRENT_DEVICES,
+                                   on_result=None):
+    import multiprocessing
+    ports = list_port_names() if ports is None else ports
+    infos, ports, results = plan_probes(ports)
+    if on_result is not None:
+        for result in results:
+            on_result(*result)
+    count = min(processes, len(ports))
+    if count:
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        shared_settings = {name: globals()[name] for name in SHARD_SHARED_SETTINGS}
+        workers = [context.Process(target=run_detect_shard, name=f"detect-shard-{shard}", daemon=True,
+                                   args=(shard, ports[shard::count], max_workers, shared_settings, events))
+                   for shard in range(count)]
+        for worker in workers:
+            worker.start()
+        running = set(range(count))
+        while running:
+            try:
+                kind, shard, value = events.get(timeout=0.5)
+            except queue.Empty:
+                running = {shard for shard in running if workers[shard].is_alive()}
+                continue
+            if kind == "done":
+                running.discard(shard)
+                continue
+            if kind == "metrics":
+                command_metrics.merge(value)
+                continue
+            port, is_chameleon, message = value
+            if port in infos:
+                probe_cache.put(infos[port], is_chameleon, message)
+            if on_result is not None:
+                on_result(port, is_chameleon, message)
+            results.append(value)
+        for worker in workers:
+            worker.join()
+    return results
+
+# 多进程分片刷写：把串口轮流分给 processes 个子进程，每个子进程有独立的解释器和 GIL，
+# 运行自己的刷写引擎；主进程汇总进度、结果、日志和刷写记录，对外接口与 FlashJob 相同
+class ShardedFlashJob(FlashJobBase):
+    def __init__(self, ports, settings, serial_numbers, report, processes=SHARD_PROCESSES,
+                 max_workers=MAX_CONCURRENT_DEVICES, pipeline_window=PIPELINE_WINDOW, ledger=None, plan=None):
+        super().__init__(ports, settings, serial_numbers, report, pipeline_window, ledger, plan)
+        self.processes = max(1, processes)
+        self.max_workers = max(1, max_workers)
+
+    def run(self):
+        import multiprocessing
+        count = min(self.processes, len(self.ports)) or 1
+        log_debug(f"ShardedFlashJob 启动，设备数: {len(self.ports)}, 进程数: {count}")
+        # 子进程要自己打开串口，主进程连接池中的连接先关闭
+        for port in self.ports:
+            connection_pool.evict(port)
+
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        shared_settings = {name: globals()[name] for name in SHARD_SHARED_SETTINGS}
+        shards = [self.ports[i::count] for i in range(count)]
+        processes = []
+        for shard, ports in enumerate(shards):
+            serial_numbers = {port: self.serial_numbers[port] for port in ports if port in self.serial_numbers}
+            process = context.Process(
+                target=run_shard, name=f"shard-{shard}", daemon=True,
+                args=(shard, ports, self.settings, self.plan.profile, serial_numbers, self.max_workers,
+                      self.pipeline_window,
+                      self.ledger is not None, bool(debug_handlers), shared_settings, events))
+            process.start()
+            processes.append(process)
+
+        running = set(range(count))
+        while running:
+            try:
+                kind, shard, value = events.get(timeout=0.5)
+            except queue.Empty:
+                for shard in list(running):
+                    if not processes[shard].is_alive():
+                        running.discard(shard)
+                        for port in shards[shard]:
+                            self.add_error(port, f"{port} 分片进程意外退出: {processes[shard].exitcode}")
+                continue
+            self.handle_event(kind, shard, value, running)
+
+        for process in processes:
+            process.join()
+        return self.collect_errors()
+
+    def handle_event(self, kind, shard, value, running):
+        if kind == "task_done":
+            self.task_done()
+        elif kind == "logs":
+            for line in value:
+                log_debug(f"[分片 {shard}] {line}")
+        elif kind == "record":
+            if self.ledger is not None:
+                self.ledger.add(value)
+        elif kind == "metrics":
+            command_metrics.merge(value)
+        elif kind == "done":
+            for port, errors in value.items():
+                self.device_errors[port].extend(errors)
+            running.discard(shard)
+        else:
+            self.report(kind, value)
+
+# 异步串口设备：安装了 pyserial-asyncio 时在事件循环内直接收发，
+# 否则退回到线程池中执行阻塞的 SerialDevice 调用
+class AsyncSerialDevice:
+    # device 为已打开的 SerialDevice（如取自连接池）时不再打开串口，收发走线程池
+    def __init__(self, port, limiter=None, device=None):
+        self.port = port
+        self.limiter = limiter
+        self.reader = None
+        self.writer = None
+        self.device = device
+        self.is_connected = device is not None and device.is_connected
+        self.first_byte_at = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        if self.is_connected:
+            return True, "连接成功"
+        if serial_asyncio is None:
+            self.device = SerialDevice(self.port)
+            success, message = await asyncio.get_running_loop().run_in_executor(None, self.device.connect)
+            self.is_connected = success
+            return success, message
+        log_debug(f"尝试连接串口: {self.port}")
+        try:
+            self.reader, self.writer = await serial_asyncio.open_serial_connection(url=self.port, baudrate=115200)
+            self.is_connected = True
+            log_debug(f"{self.port} 连接成功")
+            return True, "连接成功"
+        except (serial.SerialException, OSError) as e:
+            self.is_connected = False
+            log_debug(f"{self.port} 连接失败: {str(e)}")
+            return False, f"连接失败: {str(e)}"
+
+    # 丢弃串口中残留的输入（超时命令迟到的响应等），对应 SerialDevice 的 reset_input_buffer；
+    # 已进入 reader 缓冲区的残留帧由调用方按命令号跳过
+    def discard_input(self):
+        port = getattr(self.writer.transport, "serial", None)
+        if port is not None:
+            port.reset_input_buffer()
+
+    async def read_frame(self):
+        # readuntil 会丢弃 SYNC 之前的杂散字节
+        await self.reader.readuntil(FRAME_SYNC)
+        self.first_byte_at = time.perf_counter()
+        header = FRAME_SYNC + await self.reader.readexactly(FRAME_HEADER_SIZE - len(FRAME_SYNC))
+        length = int.from_bytes(header[6:8], byteorder='big')
+        body = await self.reader.readexactly(length + 1)
+        return header + body
+
+    # lock 保证同一设备的命令按顺序收发，limiter 限制全局在途命令数（背压）
+    async def send_command(self, command, timeout=None):
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
+        if not self.is_connected:
+            log_debug(f"{self.port} 未连接，无法发送命令")
+            return False, "未连接"
+        async with self.lock, self.limiter or contextlib.nullcontext():
+            if self.device is not None:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, self.device.send_command, command, timeout)
+            started = time.perf_counter()
+            written = None
+            self.first_byte_at = None
+            try:
+                if debug_handlers:
+                    log_debug(f"{self.port} 发送命令: {command.hex()}")
+                self.discard_input()
+                self.writer.write(command)
+                await self.writer.drain()
+                written = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + timeout
+                # 跳过命令号不符的残留响应，直到收到本命令的响应或超时
+                while True:
+                    response = await asyncio.wait_for(self.read_frame(), deadline - loop.time())
+                    if command_id(response) == command_id(command):
+                        break
+                    log_debug(f"{self.port} 丢弃无法匹配的响应: {response.hex()}")
+                command_metrics.record(self.port, command, started, written, self.first_byte_at,
+                                       time.perf_counter(), response)
+                if debug_handlers:
+                    log_debug(f"{self.port} 接收响应: {response.hex()}")
+                return decode_result(self.port, response)
+            except asyncio.TimeoutError:
+                command_metrics.record(self.port, command, started, written, self.first_byte_at, None, b'')
+                log_debug(f"{self.port} 响应超时")
+                return False, "响应超时"
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                command_metrics.record(self.port, command, started, written, self.first_byte_at, None, b'')
+                log_debug(f"{self.port} 响应不完整: {str(e)}")
+                return False, f"响应不完整: {str(e)}"
+            except (serial.SerialException, OSError) as e:
+                command_metrics.record(self.port, command, started, written, None, None, None)
+                log_debug(f"{self.port} 命令发送失败: {str(e)}")
+                return False, f"命令发送失败: {str(e)}"
+
+    # 流水线发送，语义同 SerialDevice.send_pipelined；一批命令只占用一个在途名额
+    async def send_pipelined(self, commands, timeout=None):
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
+        if not self.is_connected:
+            log_debug(f"{self.port} 未连接，无法发送命令")
+            return [(False, "未连接")] * len(commands)
+        async with self.lock, self.limiter or contextlib.nullcontext():
+            if self.device is not None:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, self.device.send_pipelined, commands, timeout)
+            results = [(False, "响应超时")] * len(commands)
+            pending = {command_id(command): index for index, command in enumerate(commands)}
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            written = None
+            try:
+                if debug_handlers:
+                    log_debug(f"{self.port} 流水线发送命令: {[command.hex() for command in commands]}")
+                self.discard_input()
+                self.writer.write(b''.join(commands))
+                await self.writer.drain()
+                written = time.perf_counter()
+                deadline = loop.time() + timeout * len(commands)
+                while pending:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    response = await asyncio.wait_for(self.read_frame(), remaining)
+                    index = pending.pop(command_id(response), None)
+                    if index is None:
+                        log_debug(f"{self.port} 丢弃无法匹配的响应: {response.hex()}")
+                        continue
+                    command_metrics.record(self.port, commands[index], started, written, self.first_byte_at,
+                                           time.perf_counter(), response)
+                    if debug_handlers:
+                        log_debug(f"{self.port} 接收响应: {response.hex()}")
+                    results[index] = decode_result(self.port, response)
+            except asyncio.TimeoutError:
+                log_debug(f"{self.port} 响应超时")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, serial.SerialException, OSError) as e:
+                log_debug(f"{self.port} 命令发送失败: {str(e)}")
+                for index in pending.values():
+                    command_metrics.record(self.port, commands[index], started, written, None, None, None)
+                    results[index] = (False, f"命令发送失败: {str(e)}")
+                pending.clear()
+            for index in pending.values():
+                command_metrics.record(self.port, commands[index], started, written, None, None, b'')
+            return results
+
+    async def close(self):
+        if not self.is_connected:
+            return
+        log_debug(f"关闭串口: {self.port}")
+        if self.device is not None:
+            self.device.close()
+        else:
+            self.writer.close()
+        self.is_connected = False
+
+# 异步检测单个串口是否为 ChameleonUltra，返回 (port, is_chameleon, message, firmware)；
+# firmware 为固件版本文本，pyserial-asyncio 的连接不进连接池，版本号只能从这里取得
+async def async_probe_port(port, limiter=None, timeout=None):
+    device = AsyncSerialDevice(port, limiter)
+    success, message = await device.connect()
+    if not success:
+        return port, False, message, ""
+    try:
+        success, response = await device.send_command(COMMANDS["get_firmware_version"], timeout)
+        if not success:
+            return port, False, response, ""
+        is_chameleon, message = validate_firmware_response(port, response.raw)
+        if is_chameleon and device.device is not None:
+            device.device.firmware_response = response.raw
+        return port, is_chameleon, message, firmware_version_text(response.raw) if is_chameleon else ""
+    finally:
+        # 未安装 pyserial-asyncio 时底层是 SerialDevice，可以留在连接池中
+        if device.device is not None and device.device.firmware_response is not None:
+            keep_connection(device.device, True)
+        else:
+            await device.close()
+
+# 异步刷写引擎：单个事件循环驱动全部设备
+class AsyncFlashEngine(FlashJobBase):
+    def __init__(self, ports, settings, serial_numbers, report, max_inflight=ASYNC_MAX_INFLIGHT,
+                 pipeline_window=PIPELINE_WINDOW, ledger=None, plan=None):
+        super().__init__(ports, settings, serial_numbers, report, pipeline_window, ledger, plan)
+        self.max_inflight = max(1, max_inflight)
+        self.pooled_firmware = {}
+
+    async def run(self):
+        self.start_records()
+        # pyserial-asyncio 自己打开串口；借用连接池中的 SerialDevice 会让每条命令都经过默认线程池，
+        # 因此和 ShardedFlashJob 一样先关闭池中的连接，只留下检测时读到的固件版本
+        if CONNECTION_POOL_ENABLED and serial_asyncio is not None:
+            for port in self.ports:
+                self.pooled_firmware[port] = connection_pool.firmware_response(port)
+                connection_pool.evict(port)
+        limiter = asyncio.Semaphore(self.max_inflight)
+        results = await asyncio.gather(
+            *(self.process_port(port, limiter) for port in self.ports), return_exceptions=True)
+        for port, result in zip(self.ports, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                self.add_error(port, f"{port} 处理异常: {str(result)}")
+        return self.collect_errors()
+
+    async def process_port(self, port, limiter):
+        log_debug(f"开始处理设备: {port}")
+        record = self.new_record(port)
+        self.report("device", (port, "flashing"))
+        pooled = None
+        if CONNECTION_POOL_ENABLED and serial_asyncio is None:
+            pooled = await asyncio.get_running_loop().run_in_executor(None, connection_pool.acquire, port)
+        device = AsyncSerialDevice(port, limiter, pooled)
+        try:
+            success, message = await device.connect()
+            if not success:
+                self.connect_failed(port, message)
+                return
+
+            if pooled is not None:
+                self.report("debug", f"{port} 复用已验证的连接")
+                if pooled.firmware_response:
+                    record["firmware_version"] = firmware_version_text(pooled.firmware_response)
+            else:
+                self.report("debug", f"{port} 连接成功")
+                if self.pooled_firmware.get(port):
+                    record["firmware_version"] = firmware_version_text(self.pooled_firmware[port])
+
+            skip = frozenset()
+            if self.differential:
+                if self.pipeline_window > 1:
+                    pipelined = await device.send_pipelined(DEVICE_STATE_COMMANDS)
+                    results = [await async_send_with_policy(device, command, result)
+                               for command, result in zip(DEVICE_STATE_COMMANDS, pipelined)]
+                else:
+                    results = [await async_send_with_policy(device, command) for command in DEVICE_STATE_COMMANDS]
+                skip = self.apply_device_state(port, record, results)
+
+            for batch in self.device_batches(port, skip):
+                self.report_task(port, batch)
+                started = time.perf_counter()
+                if len(batch) == 1:
+                    results = [await async_send_with_policy(device, batch[0]["command"], None, batch[0]["timeout"])]
+                else:
+                    # 流水线中失败的命令逐条按策略重试
+                    pipelined = await device.send_pipelined([step["command"] for step in batch])
+                    results = [await async_send_with_policy(device, step["command"], result, step["timeout"])
+                               for step, result in zip(batch, pipelined)]
+                elapsed = time.perf_counter() - started
+                for step, (success, response, attempts, confirmed) in zip(batch, results):
+                    self.finish_step(record, step, success, response, elapsed, attempts, confirmed)
+        except asyncio.CancelledError:
+            # 取消时未完成的设备记为失败，刷写记录中不会出现半途而废的成功
+            self.add_error(port, f"{port} 刷写已取消")
+            raise
+        finally:
+            # 线程池收发的 SerialDevice 可以放回连接池；pyserial-asyncio 的连接直接关闭
+            if device.device is not None and device.is_connected:
+                self.release_device(port, device.device)
+            else:
+                await device.close()
+            self.finish_record(record)
@@ -0,0 +1,251 @@
+import os
+import pty
+import sys
+import tty
+import time
+import heapq
+import random
+import argparse
+import threading
+import selectors
+from chameleon_core import FRAME_SYNC, FRAME_HEADER_SIZE, SERIAL_NUMBER_LENGTH, crc16_ibm, command_id, log_debug
+
+# 变色龙 Ultra 软件模拟器（仅 Linux）：在 pty 上模拟 N 台设备，按与 COMMANDS 相同的帧格式应答，
+# 可配置延迟、抖动、丢字节、失败率和不应答率，用于在一台机器上压测检测和刷写流程
+# 例: python chameleon_sim.py --devices 200 --latency 0.005 --jitter 0.002
+# 模拟设备不在系统串口列表中，需要把打印出的 pty 路径传给 chameleon_cli.py --ports，
+# 或加入 chameleon_core.EXTRA_PORTS
+
+# 应答状态码：成功 / 参数或校验错误 / 未知命令
+SIM_STATUS_OK = 0x0068
+SIM_STATUS_INVALID_PARAMS = 0x0066
+SIM_STATUS_INVALID_CMD = 0x0067
+
+# 模拟设备的固件版本 (major, minor) 和电量百分比
+SIM_FIRMWARE_VERSION = (2, 0)
+SIM_BATTERY_PERCENT = 100
+
+# 命令 ID
+SIM_CMD_FIRMWARE_VERSION = b'\x03\xFB'
+SIM_CMD_ACTIVATE = b'\x04\x1C'
+SIM_CMD_SET_SERIAL_NUMBER = b'\x04\x1B'
+SIM_CMD_LOW_FREQ = b'\x04\x19'
+SIM_CMD_HIGH_FREQ = b'\x04\x18'
+SIM_CMD_LIGHT = b'\x04\x1A'
+SIM_CMD_GET_SETTINGS = b'\x03\xF5'
+SIM_CMD_GET_DEVICE_INFO = b'\x04\x0A'
+
+# 单字节 LRC 校验
+def lrc(data):
+    return (0x100 - sum(data)) & 0xFF
+
+# 构造应答帧: SYNC + CMD + STATUS + LEN + LRC + DATA + LRC
+def build_frame(cmd, status, data=b''):
+    header = cmd + status.to_bytes(2, 'big') + len(data).to_bytes(2, 'big')
+    return FRAME_SYNC + header + bytes([lrc(header)]) + data + bytes([lrc(data)])
+
+# 一台模拟设备的状态：激活标志、序列号和三个循环开关
+# GET_SETTINGS 应答 [低频, 高频, 按亮]；GET_DEVICE_INFO 应答 [激活, 电量] + 14 字节序列号
+class SimulatedDevice:
+    def __init__(self, index):
+        self.index = index
+        self.activated = False
+        self.serial_number = f"SIM{index:011d}"[-SERIAL_NUMBER_LENGTH:]
+        self.low_freq = True
+        self.high_freq = True
+        self.light = True
+        self.frames = 0
+
+    # 处理一帧完整请求，返回应答帧
+    def handle(self, frame):
+        self.frames += 1
+        cmd = command_id(frame)
+        data = bytes(frame[FRAME_HEADER_SIZE:-1])
+        if cmd == SIM_CMD_SET_SERIAL_NUMBER:
+            # 序列号帧以 CRC16 结尾而不是 LRC
+            if crc16_ibm(frame[:-2]) != bytes(frame[-2:]):
+                return build_frame(cmd, SIM_STATUS_INVALID_PARAMS)
+            self.serial_number = bytes(frame[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + SERIAL_NUMBER_LENGTH]).decode('ascii', 'replace')
+            return build_frame(cmd, SIM_STATUS_OK)
+        if lrc(data) != frame[-1]:
+            return build_frame(cmd, SIM_STATUS_INVALID_PARAMS)
+        if cmd == SIM_CMD_FIRMWARE_VERSION:
+            return build_frame(cmd, SIM_STATUS_OK, bytes(SIM_FIRMWARE_VERSION))
+        if cmd == SIM_CMD_ACTIVATE:
+            self.activated = True
+            return build_frame(cmd, SIM_STATUS_OK)
+        if cmd in (SIM_CMD_LOW_FREQ, SIM_CMD_HIGH_FREQ, SIM_CMD_LIGHT):
+            if len(data) != 1:
+                return build_frame(cmd, SIM_STATUS_INVALID_PARAMS)
+            enabled = data[0] != 0
+            if cmd == SIM_CMD_LOW_FREQ:
+                self.low_freq = enabled
+            elif cmd == SIM_CMD_HIGH_FREQ:
+                self.high_freq = enabled
+            else:
+                self.light = enabled
+            return build_frame(cmd, SIM_STATUS_OK)
+        if cmd == SIM_CMD_GET_SETTINGS:
+            return build_frame(cmd, SIM_STATUS_OK, bytes([self.low_freq, self.high_freq, self.light]))
+        if cmd == SIM_CMD_GET_DEVICE_INFO:
+            info = bytes([self.activated, SIM_BATTERY_PERCENT]) + self.serial_number.encode('ascii', 'replace')
+            return build_frame(cmd, SIM_STATUS_OK, info)
+        return build_frame(cmd, SIM_STATUS_INVALID_CMD)
+
+# 从接收缓冲区中切出完整请求帧；遇到无效帧头时丢弃一个字节重新同步
+def split_frames(buffer):
+    frames = []
+    while True:
+        start = buffer.find(FRAME_SYNC)
+        if start < 0:
+            del buffer[:max(0, len(buffer) - 1)]
+            return frames
+        del buffer[:start]
+        if len(buffer) < FRAME_HEADER_SIZE:
+            return frames
+        if lrc(buffer[2:8]) != buffer[8]:
+            del buffer[:1]
+            continue
+        size = FRAME_HEADER_SIZE + int.from_bytes(buffer[6:8], 'big') + 1
+        if len(buffer) < size:
+            return frames
+        frames.append(bytes(buffer[:size]))
+        del buffer[:size]
+
+# 模拟器：为每台设备打开一对 pty，单线程用 selector 读取全部请求，按计划时间写回应答
+class ChameleonSimulator:
+    def __init__(self, count, latency=0.0, jitter=0.0, drop_rate=0.0, failure_rate=0.0,
+                 timeout_rate=0.0, seed=None):
+        self.count = count
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.devices = {}
+        self.ports = []
+        self.pending = []
+        self.sequence = 0
+        self.stats = {"frames": 0, "dropped_bytes": 0, "failures": 0, "timeouts": 0}
+        self.running = False
+        self.thread = None
+        self.wake_read, self.wake_write = os.pipe()
+
+    def start(self):
+        for index in range(self.count):
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            port = os.ttyname(slave)
+            # 模拟器持有从端，客户端关闭串口后主端不会收到 EIO
+            self.devices[master] = {
+                "device": SimulatedDevice(index), "port": port, "slave": slave,
+                "buffer": bytearray(), "ready_at": 0.0,
+            }
+            self.selector.register(master, selectors.EVENT_READ)
+            self.ports.append(port)
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="chameleon-sim", daemon=True)
+        self.thread.start()
+        log_debug(f"模拟器已启动: {self.count} 台设备")
+        return self.ports
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_write, b'\0')
+        if self.thread is not None:
+            self.thread.join()
+        for master, entry in self.devices.items():
+            self.selector.unregister(master)
+            os.close(master)
+            os.close(entry["slave"])
+        self.devices.clear()
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        log_debug(f"模拟器已停止: {self.stats}")
+
+    # 对应答施加故障注入，并按延迟和抖动排入发送计划；同一设备的应答保持顺序
+    def schedule(self, master, entry, reply):
+        if self.random.random() < self.timeout_rate:
+            self.stats["timeouts"] += 1
+            return
+        if self.random.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            reply = build_frame(reply[2:4], SIM_STATUS_INVALID_PARAMS)
+        if self.random.random() < self.drop_rate:
+            self.stats["dropped_bytes"] += 1
+            position = self.random.randrange(len(reply))
+            reply = reply[:position] + reply[position + 1:]
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        due = max(time.monotonic() + delay, entry["ready_at"])
+        entry["ready_at"] = due
+        self.sequence += 1
+        heapq.heappush(self.pending, (due, self.sequence, master, reply))
+
+    def receive(self, master):
+        entry = self.devices[master]
+        try:
+            data = os.read(master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        entry["buffer"] += data
+        for frame in split_frames(entry["buffer"]):
+            self.stats["frames"] += 1
+            self.schedule(master, entry, entry["device"].handle(frame))
+
+    def flush_due(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            _, _, master, reply = heapq.heappop(self.pending)
+            try:
+                os.write(master, reply)
+            except (BlockingIOError, OSError) as e:
+                log_debug(f"{self.devices[master]['port']} 模拟应答写入失败: {str(e)}")
+
+    def run(self):
+        while self.running:
+            timeout = max(0.0, self.pending[0][0] - time.monotonic()) if self.pending else None
+            for key, _ in self.selector.select(timeout):
+                if key.fd == self.wake_read:
+                    os.read(self.wake_read, 64)
+                else:
+                    self.receive(key.fd)
+            self.flush_due()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="变色龙 Ultra 软件模拟器")
+    parser.add_argument("--devices", type=int, default=1, help="模拟设备数")
+    parser.add_argument("--latency", type=float, default=0.0, help="应答延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="应答延迟抖动（秒）")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="应答中丢失一个字节的概率")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="应答错误状态的概率")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="不应答的概率")
+    parser.add_argument("--seed", type=int, help="故障注入的随机种子")
+    parser.add_argument("--ports-file", help="把 pty 路径逐行写入该文件")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    simulator = ChameleonSimulator(args.devices, args.latency, args.jitter, args.drop_rate,
+                                   args.failure_rate, args.timeout_rate, args.seed)
+    ports = simulator.start()
+    if args.ports_file:
+        with open(args.ports_file, "w") as f:
+            f.write("\n".join(ports) + "\n")
+    print(" ".join(ports), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        print(simulator.stats, file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())